@@ -0,0 +1,189 @@
+import cilcdjango.core.settings as _settings
+
+from django.core.cache import cache
+from django.core.urlresolvers import get_resolver, reverse, NoReverseMatch
+
+import threading
+import time
+
+class AjaxViewRegistry(object):
+	"""
+	A registry of the views decorated with the `ajax_view` decorator.
+
+	Views are added to the registry when they are decorated, which happens as
+	their modules are imported. The first time that the URLs of the views are
+	requested, the project's URL configuration is walked once, under a lock,
+	to find the name and URL of each registered view that it includes. The
+	results are reused until the URL configuration itself changes or the
+	registry is cleared. The `generation` attribute is incremented each time
+	that the views are found again.
+
+	This can be resolved at startup, such as from a WSGI script, as follows:
+
+	>>> from cilcdjango.core.ajax import ajax_views
+	>>> ajax_views.resolve()
+
+	"""
+
+	def __init__(self):
+		self._views     = set()
+		self._lock      = threading.Lock()
+		self._resolved  = None
+		self.generation = 0
+
+	def register(self, view):
+		"""Add the view function `view` to the registry."""
+		self._views.add(view)
+
+	def is_ajax_view(self, view):
+		"""
+		Return True if `view` is a registered view, or if it wraps one and has
+		thus inherited its AJAX view flag.
+		"""
+		return view in self._views or hasattr(view, _settings.AJAX_VIEW_FLAG)
+
+	def _find_views(self, patterns, urls, views):
+		"""
+		Add the name and URL of each AJAX view in `patterns` to the `urls` dict
+		and the view itself to the `views` dict, recursing into any included
+		groups of URLs.
+		"""
+		for pattern in patterns:
+			if hasattr(pattern, 'url_patterns'):
+				self._find_views(pattern.url_patterns, urls, views)
+			elif pattern.name and self.is_ajax_view(pattern.callback):
+
+				#  Only include views that can be resolved without any args or
+				#  kwargs, implying that they receive their data via POST or GET
+				try:
+					urls[pattern.name] = reverse(pattern.name)
+				except NoReverseMatch:
+					pass
+				else:
+					views[pattern.name] = pattern.callback
+
+	def resolve(self):
+		"""
+		Find the name and URL of every AJAX view included in the project's URL
+		configuration, doing nothing if this has already been done for the
+		current configuration.
+		"""
+		resolver = get_resolver(None)
+		resolved = self._resolved
+		if resolved is not None and resolved[0] is resolver:
+			return resolved
+		with self._lock:
+			if self._resolved is None or self._resolved[0] is not resolver:
+				urls = {}
+				views = {}
+				self._find_views(resolver.url_patterns, urls, views)
+				self._resolved = (resolver, urls, views)
+				self.generation += 1
+			return self._resolved
+
+	def clear(self):
+		"""Discard the resolved URLs, so that they are found again when next used."""
+		with self._lock:
+			self._resolved = None
+
+	def get_generation(self):
+		"""Return the generation of the views found in the current URL configuration."""
+		self.resolve()
+		return self.generation
+
+	def get_urls(self):
+		"""Return a dict whose keys are the names of AJAX views and whose values are their URLs."""
+		return dict(self.resolve()[1])
+
+	def get_view(self, name):
+		"""Return the AJAX view whose URL pattern is named `name`, or None if there is none."""
+		return self.resolve()[2].get(name)
+
+ajax_views = AjaxViewRegistry()
+
+class ConcurrencyLimiter(object):
+	"""
+	Limits the number of concurrent executions of an AJAX view to
+	`max_concurrent`, so that a burst of requests to an expensive view cannot
+	occupy every worker thread.
+
+	A request that finds the view saturated waits up to `queue_timeout` seconds
+	for a slot. The limit always applies within the current process. If
+	`shared` is True, it is also applied across all processes using a counter
+	in the cache, which expires an hour after it was created so that slots
+	held by a crashed process are eventually released. Its expiry is not
+	refreshed by later requests, as the cache API offers no way to do so
+	without racing other processes, so when it expires while slots are held,
+	up to twice `max_concurrent` executions can briefly run across processes.
+	"""
+
+	_KEY_PREFIX = "cilc:ajax:concurrency"
+	_SHARED_TIMEOUT = 60 * 60
+	_SHARED_POLL_INTERVAL = 0.05
+
+	def __init__(self, view_name, max_concurrent, queue_timeout=0, shared=False):
+		self.view_name = view_name
+		self.max_concurrent = max_concurrent
+		self.queue_timeout = queue_timeout
+		self.shared = shared
+		self.rejected = 0
+		self._condition = threading.Condition(threading.Lock())
+		self._running = 0
+		self._key = "%s:%s" % (self._KEY_PREFIX, view_name)
+
+	def _acquire_local(self, deadline):
+		"""Take a slot in this process, waiting until `deadline` for one to be free."""
+		with self._condition:
+			while self._running >= self.max_concurrent:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return False
+				self._condition.wait(remaining)
+			self._running += 1
+			return True
+
+	def _release_local(self):
+		"""Free a slot in this process."""
+		with self._condition:
+			self._running -= 1
+			self._condition.notify()
+
+	def _acquire_shared(self, deadline):
+		"""Take a slot shared by all processes, polling until `deadline` for one to be free."""
+		while True:
+			cache.add(self._key, 0, self._SHARED_TIMEOUT)
+			try:
+				count = cache.incr(self._key)
+			except ValueError:
+				count = None
+			if count is not None:
+				if count <= self.max_concurrent:
+					return True
+				self._release_shared()
+			if time.time() >= deadline:
+				return False
+			time.sleep(self._SHARED_POLL_INTERVAL)
+
+	def _release_shared(self):
+		"""Free a slot shared by all processes."""
+		try:
+			cache.decr(self._key)
+		except ValueError:
+			pass
+
+	def acquire(self):
+		"""Take a slot for an execution of the view, returning False if none became free."""
+		deadline = time.time() + self.queue_timeout
+		if self._acquire_local(deadline):
+			if not self.shared or self._acquire_shared(deadline):
+				return True
+			self._release_local()
+		with self._condition:
+			self.rejected += 1
+		return False
+
+	def release(self):
+		"""Free the slot taken by a successful call to `acquire`."""
+		if self.shared:
+			self._release_shared()
+		self._release_local()
@@ -0,0 +1,309 @@
+from cilcdjango.core.util import get_app_setting
+
+from django.core.cache import cache
+from django.db.models import Model, signals
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+import threading
+import time
+
+_VERSION_KEY_PREFIX = "cilc:version"
+
+#  Version stamps outlive anything cached with them, so they are kept for a month
+_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+_fragment_state = threading.local()
+
+#  The response caches of AJAX views, keyed by view name
+_ajax_response_caches = {}
+
+#-------------------------------------------------------------------------------
+#  Version Stamps
+#-------------------------------------------------------------------------------
+
+def _new_version():
+	"""
+	Return a version number based on the current time, so that a version stamp
+	that has been evicted from the cache is never restarted at a value that it
+	has already had.
+	"""
+	return int(time.time() * 1000)
+
+def _model_version_key(model):
+	"""Return the cache key of the version stamp for the model class `model`."""
+	return "%s:%s.%s" % (_VERSION_KEY_PREFIX, model._meta.app_label, model._meta.object_name.lower())
+
+def _instance_version_key(instance):
+	"""Return the cache key of the version stamp for the model instance `instance`."""
+	return "%s:%s" % (_model_version_key(instance.__class__), smart_str(instance.pk))
+
+def version_keys_for(obj):
+	"""
+	Return a list of the version stamp keys that the value of `obj` depends on,
+	or an empty list if `obj` is not model data.
+
+	A model instance depends on its own version, while a model class, a
+	QuerySet or a manager depends on the version of the entire model.
+	"""
+	if isinstance(obj, Model):
+		return [_instance_version_key(obj)]
+	if isinstance(obj, type) and issubclass(obj, Model):
+		return [_model_version_key(obj)]
+	if isinstance(obj, QuerySet) or hasattr(obj, 'get_query_set'):
+		return [_model_version_key(obj.model)]
+	return []
+
+def _query_identity(obj):
+	"""
+	Return a string identifying the rows selected by the QuerySet or manager
+	`obj`, such as a related manager that only selects one object's rows.
+	"""
+	if not isinstance(obj, QuerySet):
+		obj = obj.get_query_set()
+	try:
+		return smart_str(obj.query)
+	except EmptyResultSet:
+		return "<empty>"
+
+def get_versions(keys):
+	"""
+	Return a dict whose keys are the version stamp keys in the `keys` iterable
+	and whose values are the current version of each key, creating a version
+	for any key that does not have one yet.
+	"""
+	keys = list(keys)
+	if not keys:
+		return {}
+	versions = cache.get_many(keys)
+	for key in keys:
+		if key not in versions:
+			cache.add(key, _new_version(), _VERSION_TIMEOUT)
+			versions[key] = cache.get(key)
+	return versions
+
+def bump_version(key):
+	"""Increment the version stamp with the cache key `key`."""
+	try:
+		cache.incr(key)
+	except ValueError:
+		cache.set(key, _new_version(), _VERSION_TIMEOUT)
+
+def version_stamp(*objs):
+	"""
+	Return a string that changes whenever any of the model data passed as
+	positional arguments changes. Values other than model data are ignored.
+	"""
+	keys = []
+	for obj in objs:
+		keys.extend(version_keys_for(obj))
+	versions = get_versions(keys)
+	return ".".join([smart_str(versions[key]) for key in sorted(versions)])
+
+def _bump_model_versions(sender, instance=None, **kwargs):
+	"""
+	Invalidate the version stamps for a saved or deleted model instance and for
+	the instance's model, as well as for the other side of a changed
+	many-to-many relation.
+	"""
+	if instance is None:
+		return
+	bump_version(_model_version_key(instance.__class__))
+	if instance.pk is not None:
+		bump_version(_instance_version_key(instance))
+	related_model = kwargs.get('model')
+	if related_model is not None:
+		bump_version(_model_version_key(related_model))
+
+signals.post_save.connect(_bump_model_versions, dispatch_uid="cilc-version-post-save")
+signals.post_delete.connect(_bump_model_versions, dispatch_uid="cilc-version-post-delete")
+signals.m2m_changed.connect(_bump_model_versions, dispatch_uid="cilc-version-m2m-changed")
+
+#-------------------------------------------------------------------------------
+#  Fragment Caching
+#-------------------------------------------------------------------------------
+
+class FragmentCache(object):
+	"""
+	A cache for rendered markup that is keyed by the version stamps of the model
+	data that the markup depends on.
+
+	A cached fragment is served until its soft timeout passes. After that, one
+	renderer regenerates it while any concurrent requests are served the last
+	rendered copy, which prevents a stampede of identical renders when a
+	popular fragment expires or its data changes.
+
+	Fragments can be nested. The version stamps used by an inner fragment are
+	recorded along with the outer fragment's markup, so a change to the inner
+	fragment's data also invalidates the outer fragment.
+	"""
+
+	_KEY_PREFIX = "cilc:fragment"
+
+	#  The longest time that a crashed renderer can keep others from rendering
+	_LOCK_TIMEOUT = 30
+
+	def __init__(self, name, key_parts, objs, timeout=None):
+		"""
+		Create a cache for the fragment called `name`, whose markup varies with
+		the values in the `key_parts` iterable and with the versions of the
+		model data in the `objs` iterable. A QuerySet or manager in `objs` also
+		varies the markup with the query that it makes, as its version is that
+		of its entire model.
+		"""
+
+		self.timeout = timeout or get_app_setting('FRAGMENT_CACHE_TIMEOUT')
+		self._version_keys = []
+		literals = [smart_str(part) for part in key_parts]
+		for obj in objs:
+			keys = version_keys_for(obj)
+			if keys:
+				self._version_keys.extend(keys)
+				if isinstance(obj, QuerySet) or hasattr(obj, 'get_query_set'):
+					literals.append(_query_identity(obj))
+			else:
+				literals.append(smart_str(obj))
+
+		base = md5_constructor(":".join([smart_str(name)] + literals)).hexdigest()
+		self._stale_key = "%s:%s:stale" % (self._KEY_PREFIX, base)
+		self._lock_key  = "%s:%s:lock" % (self._KEY_PREFIX, base)
+		self._base_key  = base
+
+	def _versioned_key(self, versions):
+		"""Return the cache key for the markup rendered with `versions`."""
+		stamp = ".".join([smart_str(versions[key]) for key in self._version_keys])
+		return "%s:%s:%s" % (self._KEY_PREFIX, self._base_key, md5_constructor(stamp).hexdigest())
+
+	def _report_dependencies(self, versions):
+		"""Make the versions used by this fragment known to an enclosing fragment."""
+		stack = getattr(_fragment_state, 'stack', None)
+		if stack:
+			stack[-1].update(versions)
+
+	def _is_current(self, entry):
+		"""Return True if the nested dependencies of the cached `entry` are unchanged."""
+		nested = entry['nested']
+		return not nested or get_versions(nested.keys()) == nested
+
+	def get_or_render(self, render_function):
+		"""
+		Return the cached markup for the fragment, calling `render_function`
+		to produce it if no current copy is cached.
+		"""
+
+		versions = get_versions(self._version_keys)
+		key = self._versioned_key(versions)
+		entry = cache.get(key)
+
+		#  Serve the cached copy if it is fresh, or if it is stale but another
+		#  renderer is already regenerating it
+		if entry is not None and self._is_current(entry):
+			if entry['fresh_until'] > time.time():
+				owns_lock = False
+			else:
+				owns_lock = cache.add(self._lock_key, 1, self._LOCK_TIMEOUT)
+			if not owns_lock:
+				versions.update(entry['nested'])
+				self._report_dependencies(versions)
+				return entry['markup']
+		else:
+			owns_lock = cache.add(self._lock_key, 1, self._LOCK_TIMEOUT)
+			if not owns_lock:
+				stale = cache.get(self._stale_key)
+				if stale is not None:
+					self._report_dependencies(stale['versions'])
+					return stale['markup']
+
+		#  Render the fragment, collecting the versions of any nested fragments
+		stack = getattr(_fragment_state, 'stack', None)
+		if stack is None:
+			stack = _fragment_state.stack = []
+		stack.append({})
+		try:
+			markup = render_function()
+		finally:
+			nested = stack.pop()
+			if owns_lock:
+				cache.delete(self._lock_key)
+
+		#  Keep the markup for twice the timeout so that a stale copy remains
+		#  available while a fresh one is being rendered
+		entry = {
+			'markup': markup,
+			'nested': nested,
+			'fresh_until': time.time() + self.timeout
+		}
+		cache.set(key, entry, self.timeout * 2)
+
+		#  Keep the stale copy with the versions that it depends on, so that an
+		#  enclosing fragment served it still records those dependencies
+		versions.update(nested)
+		cache.set(self._stale_key, {'markup': markup, 'versions': versions}, self.timeout * 2)
+		self._report_dependencies(versions)
+		return markup
+
+#-------------------------------------------------------------------------------
+#  AJAX Response Caching
+#-------------------------------------------------------------------------------
+
+class AjaxResponseCache(object):
+	"""
+	A cache for the JSON responses of an AJAX view whose output depends only
+	on its keyword arguments and on the state of certain models.
+
+	Responses are keyed by the view's name, its coerced keyword arguments, the
+	request's language and security, and the version stamps of the model data
+	in `vary_on`, so saving or deleting any of that data invalidates them. The
+	number of cache hits and misses in the current process is counted.
+	"""
+
+	_KEY_PREFIX = "cilc:ajax"
+
+	def __init__(self, view_name, timeout, vary_on=None):
+		self.view_name = view_name
+		self.timeout = timeout
+		self.vary_on = list(vary_on or [])
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		_ajax_response_caches[view_name] = self
+
+	def make_key(self, request, kwargs):
+		"""Return the cache key for the view's response to `request` with `kwargs`."""
+		parts = [
+			self.view_name,
+			getattr(request, 'LANGUAGE_CODE', ""),
+			request.is_secure(),
+			version_stamp(*self.vary_on)
+		]
+		parts.extend(["%s=%r" % (name, kwargs[name]) for name in sorted(kwargs)])
+		return "%s:%s" % (self._KEY_PREFIX, md5_constructor(":".join([smart_str(part) for part in parts])).hexdigest())
+
+	def get(self, key):
+		"""
+		Return a (content, content type) tuple for the response cached under
+		`key`, or None if it is not cached, counting the hit or miss.
+		"""
+		cached = cache.get(key)
+		with self._lock:
+			if cached is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		return cached
+
+	def set(self, key, response):
+		"""Cache the content of the HttpResponse `response` under `key`."""
+		cache.set(key, (response.content, response['Content-Type']), self.timeout)
+
+def get_ajax_cache_statistics():
+	"""
+	Return a dict whose keys are the names of the AJAX views whose responses are
+	cached and whose values are dicts giving the view's hits and misses.
+	"""
+	return dict([
+		(name, {'hits': response_cache.hits, 'misses': response_cache.misses})
+		for name, response_cache in _ajax_response_caches.items()
+	])
@@ -1,12 +1,173 @@
 
-import cilcdjango.core.settings as _settings
+from cilcdjango.core.ajax import ajax_views
 from cilcdjango.core.util import get_app_setting
 
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db.models import signals
+from django.template.context import get_standard_processors
+from django.utils.hashcompat import md5_constructor
 from django.utils.safestring import mark_safe
 
 import simplejson as json
+import threading
+
+#  Prerendered context output that does not depend on the request, along with
+#  the fingerprint of the settings it was rendered with, keyed by the context
+#  class, its JavaScript globals object and whether the request is secure
+_static_output = {}
+_static_output_lock = threading.Lock()
+
+#  The current version and script served by the external JavaScript globals
+#  file for each context class, globals object name and request security
+_javascript_globals = {}
+
+#  The context class that defines each JavaScript globals object, keyed by the
+#  name of the object
+_context_classes = {}
+
+def get_context_class(object_name):
+	"""
+	Return the context class whose JavaScript globals object is named
+	`object_name`, or None if there is no such class. The configured context
+	processors are loaded first, so that a process that has yet to render a
+	page still knows every context class that they define.
+	"""
+	if object_name not in _context_classes:
+		get_standard_processors()
+	return _context_classes.get(object_name)
+
+def get_javascript_globals(object_name, version):
+	"""
+	Return the JavaScript globals script defining the object `object_name`
+	whose version hash is `version`, or None if that is not the current version
+	of any script rendered by a context in this process.
+	"""
+	for (context_class, name, secure), (script_version, script) in _javascript_globals.items():
+		if name == object_name and script_version == version:
+			return script
+	return None
+
+def _clear_static_output(**kwargs):
+	"""Discard all prerendered context output."""
+	with _static_output_lock:
+		_static_output.clear()
+
+signals.post_save.connect(_clear_static_output, sender=Site, dispatch_uid="cilc-context-site-save")
+signals.post_delete.connect(_clear_static_output, sender=Site, dispatch_uid="cilc-context-site-delete")
+
+class LazyContext(dict):
+	"""
+	A dict of template context variables whose values can be provided lazily.
+
+	A lazy variable is added with a function that returns its value. The
+	function is only called the first time that a template reads the variable,
+	after which its value is stored in the dict. A function that returns a
+	whole dict of variables can also be added. It is called the first time that
+	the dict is searched for any name, even one that it does not contain, and
+	its values replace any variables added before it.
+
+	This relies on a Django template context reading the variables of a
+	context processor through `__contains__` and `__getitem__`.
+	"""
+
+	def __init__(self):
+		super(LazyContext, self).__init__()
+		self._order = 0
+		self._orders = {}
+		self._providers = {}
+		self._dict_providers = []
+
+	def _next_order(self):
+		self._order += 1
+		return self._order
+
+	def add_value(self, name, value):
+		"""Add a variable named `name` whose value is `value`."""
+		self._orders[name] = self._next_order()
+		self._providers.pop(name, None)
+		dict.__setitem__(self, name, value)
+
+	def add_lazy_value(self, name, provider):
+		"""
+		Add a variable named `name` whose value is returned by the function
+		`provider` when the variable is first read.
+		"""
+		self._orders[name] = self._next_order()
+		self._providers[name] = provider
+		dict.pop(self, name, None)
+
+	def add_lazy_values(self, provider):
+		"""
+		Add the variables in the dict returned by the function `provider`, which
+		is called when any variable is first read.
+		"""
+		self._dict_providers.append((self._next_order(), provider))
+
+	def _evaluate_dict_providers(self):
+		"""Add the variables from any pending dict providers."""
+		while self._dict_providers:
+			order, provider = self._dict_providers.pop(0)
+			for name, value in provider().iteritems():
+				if self._orders.get(name, 0) < order:
+					self._orders[name] = order
+					self._providers.pop(name, None)
+					dict.__setitem__(self, name, value)
+
+	def _evaluate_all(self):
+		"""Determine the value of every variable."""
+		self._evaluate_dict_providers()
+		for name in self._providers.keys():
+			self[name]
+
+	def __contains__(self, name):
+		self._evaluate_dict_providers()
+		return dict.__contains__(self, name) or name in self._providers
+
+	has_key = __contains__
+
+	def __getitem__(self, name):
+		self._evaluate_dict_providers()
+		try:
+			return dict.__getitem__(self, name)
+		except KeyError:
+			value = self._providers.pop(name)()
+			dict.__setitem__(self, name, value)
+			return value
+
+	def get(self, name, default=None):
+		return self[name] if name in self else default
+
+	def __iter__(self):
+		self._evaluate_all()
+		return dict.__iter__(self)
+
+	def __len__(self):
+		self._evaluate_all()
+		return dict.__len__(self)
+
+	def keys(self):
+		self._evaluate_all()
+		return dict.keys(self)
+
+	def values(self):
+		self._evaluate_all()
+		return dict.values(self)
+
+	def items(self):
+		self._evaluate_all()
+		return dict.items(self)
+
+	def iteritems(self):
+		self._evaluate_all()
+		return dict.iteritems(self)
+
+class ContextType(type):
+	"""Metaclass for a context, which records the class that defines each JavaScript globals object."""
+
+	def __init__(cls, name, bases, attrs):
+		super(ContextType, cls).__init__(name, bases, attrs)
+		_context_classes[cls.js_globals_object] = cls
 
 class CILCContext(object):
 	"""
@@ -25,6 +186,16 @@ class CILCContext(object):
 	the `provide_context_variables` function, which should return a dictionary
 	whose keys will be the names of template variables.
 
+	The `provide_context_variables` method is called the first time that the
+	template context searches this context's variables, which happens for any
+	variable that is not found in a context layer above them, such as "user",
+	"request" or a missing variable, so it runs for nearly every rendered
+	template. A child class whose variables are expensive to determine should
+	instead override `provide_lazy_context_variables` to return a dictionary
+	whose keys are the names of template variables and whose values are
+	functions returning the value of each variable, which are only called if
+	their variable is read.
+
 	This context also provides a special variable named "JS_GLOBAL_VARIABLES"
 	that contains markup to define JavaScript global variables.
 
@@ -37,12 +208,31 @@ class CILCContext(object):
 	`provide_javascript_globals` method, whose returned dictionary's keys will
 	be the names of global variables available through the `custom_js_settings`
 	object.
+
+	Any output that does not depend on the request is rendered once per process
+	for both secure and insecure requests, and is rendered again only if one of
+	the settings that it uses changes or if a Site is saved or deleted.
+
+	If the project includes the `cilcdjango.core.urls` URL configuration, the
+	global variables that do not depend on the request are served as an
+	external JavaScript file whose URL contains a hash of its content, so that
+	browsers can cache it indefinitely. The URL of this file is available as
+	the "JS_GLOBALS_URL" context variable, and "JS_GLOBAL_VARIABLES" then
+	contains a script tag referencing it, followed by a small inline script
+	that adds any variables provided by `provide_java_script_globals`. A
+	process that has not rendered the requested file renders it with the most
+	recently defined context class using the file's `js_globals_object`, so a
+	child class that changes the file's content should use its own name.
 	"""
 
-	_JS_GLOBALS_OBJECT_NAME  = "cilc"
-	_JS_SETTINGS_OBJECT_NAME = "cilc_settings"
-	_JS_GLOBALS_URL_VAR_NAME = "urls"
-	_JS_GLOBALS_CONTEXT_NAME = "JS_GLOBAL_VARIABLES"
+	__metaclass__ = ContextType
+
+	_JS_GLOBALS_OBJECT_NAME      = "cilc"
+	_JS_SETTINGS_OBJECT_NAME     = "cilc_settings"
+	_JS_GLOBALS_URL_VAR_NAME     = "urls"
+	_JS_GLOBALS_CONTEXT_NAME     = "JS_GLOBAL_VARIABLES"
+	_JS_GLOBALS_URL_CONTEXT_NAME = "JS_GLOBALS_URL"
+	_JS_GLOBALS_URL_NAME         = "cilc-javascript-globals"
 
 	js_globals_object = "custom_js_settings"
 
@@ -68,84 +258,131 @@ class CILCContext(object):
 			'shared_media_url': self.shared_media_url
 		}
 
-	def _add_ajax_view_to_java_script(self, pattern):
+	def _build_ajax_views(self):
+		"""Return a dict mapping the names of AJAX views to their URLs."""
+		return ajax_views.get_urls()
+
+	def _settings_fingerprint(self):
 		"""
-		Make an AJAX view decorated by the `ajax_view` decorator available via
-		its name to a JavaScript object that is a property of the custom
-		settings object.
+		Return the values of every setting used by the prerendered output,
+		along with the generation of the AJAX views that it includes.
+		"""
+		from django.conf import settings
+		return (
+			self.app_root,
+			self.shared_media_url,
+			self.app_media_url,
+			self.url_config,
+			ajax_views.get_generation(),
+			getattr(settings, 'SITE_ID', None),
+			get_app_setting('APPLICATION_NAME'),
+			get_app_setting('GOOGLE_ANALYTICS_ID')
+		)
+
+	def _render_static_output(self, secure):
+		"""
+		Return a dict of the context output that does not depend on the
+		request, using secure media URLs if `secure` is True.
 		"""
 
-		#  If the pattern is flagged as an Ajax view and can be successfully
-		#  resolved without any args or kwargs, implying that it receives its
-		#  data via POST or GET, add it to our list.
-		if hasattr(pattern.callback, _settings.AJAX_VIEW_FLAG):
-			try:
-				CILCContext._ajax_views[pattern.name] = reverse(pattern.name)
-			except NoReverseMatch:
-				pass
+		if secure:
+			self.app_media_url = self.app_media_url.replace('http:', 'https:')
+			self.shared_media_url = self.shared_media_url.replace('http:', 'https:')
 
-	def _add_ajax_views_to_java_script(self, patterns):
+		#  Serialize the core JavaScript objects and the AJAX view URLs
+		self._build_javascript_globals()
+		core_js = []
+		for js_vars, var_name in ((self._js_vars, self._JS_GLOBALS_OBJECT_NAME), (self._js_settings_vars, self._JS_SETTINGS_OBJECT_NAME)):
+			if js_vars:
+				core_js.append("%s = %s" % (var_name, json.dumps(js_vars)))
+		view_urls = self._build_ajax_views()
+		ajax_views_json = json.dumps(view_urls)
+
+		#  Build the script for the external globals file, which defines the
+		#  custom settings object with only the AJAX view URLs, and make it
+		#  available to the view that serves it if that view is installed
+		globals_script = "var %s;" % ",".join(core_js + [
+			'%s = {"%s": %s}' % (self.js_globals_object, self._JS_GLOBALS_URL_VAR_NAME, ajax_views_json)
+		])
+		globals_version = md5_constructor(globals_script).hexdigest()
+		try:
+			globals_url = reverse(self._JS_GLOBALS_URL_NAME, kwargs={
+				'object_name': self.js_globals_object,
+				'version': globals_version
+			})
+		except NoReverseMatch:
+			globals_url = None
+		else:
+			_javascript_globals[(self.__class__, self.js_globals_object, secure)] = (globals_version, globals_script)
+
+		return {
+			'ajax_views':       view_urls,
+			'ajax_views_json':  ajax_views_json,
+			'core_js':          core_js,
+			'globals_script':   globals_script,
+			'globals_url':      globals_url,
+			'globals_version':  globals_version,
+			'google_analytics': self._build_google_analytics_code(),
+			'media_url':        self.app_media_url,
+			'shared_media_url': self.shared_media_url,
+			'site_url':         Site.objects.get_current().domain
+		}
+
+	def _get_static_output(self):
 		"""
-		Add any URL patterns used by the current application to the JavaScript
-		custom globals object.
+		Return the prerendered output for the current request, rendering it if
+		it has yet to be rendered for this process or if the settings that it
+		uses have changed.
 		"""
 
-		#  Add an individual pattern if possible, and otherwise recurse to add
-		#  any included groups of URLs.
-		for pattern in patterns:
-			if hasattr(pattern, 'url_patterns'):
-				self._add_ajax_views_to_java_script(pattern.url_patterns)
-			else:
-				self._add_ajax_view_to_java_script(pattern)
+		key = (self.__class__, self.js_globals_object, self.request.is_secure())
+		fingerprint = self._settings_fingerprint()
+		entry = _static_output.get(key)
+		if entry is not None and entry[0] == fingerprint:
+			return entry[1]
 
-	def _render_java_script_globals(self):
-		"""Render the markup that defines the JavaScript global variables."""
+		with _static_output_lock:
+			entry = _static_output.get(key)
+			if entry is None or entry[0] != fingerprint:
+				entry = _static_output[key] = (fingerprint, self._render_static_output(key[2]))
+			return entry[1]
 
-		global_markup = ["<script type='text/javascript'>"]
+	def _render_java_script_globals(self, static):
+		"""
+		Render the markup that defines the JavaScript global variables, using
+		the prerendered output in `static` for the core objects.
+		"""
 
-		#  Add any available AJAX view URLs to the custom settings object.
-		try:
-			exec("from %s import urlpatterns" % self.url_config)
-		except ImportError:
-			pass
+		#  The AJAX view URLs always fill the settings object's URL dict, so
+		#  only any other custom variables need to be serialized
+		custom_vars = dict(self._custom_js_vars)
+		custom_vars.pop(self._JS_GLOBALS_URL_VAR_NAME, None)
+
+		#  Reference the external globals file, adding only the custom
+		#  variables for this request to its settings object
+		if static['globals_url']:
+			markup = ["<script type='text/javascript' src='%s'></script>" % static['globals_url']]
+			if custom_vars:
+				markup.extend([
+					"<script type='text/javascript'>",
+					"(function(s, v) { for (var k in v) { s[k] = v[k]; } })(%s, %s);" % (self.js_globals_object, json.dumps(custom_vars)),
+					"</script>"
+				])
+			return mark_safe("\n".join(markup))
+
+		#  Or define every variable inline if the file cannot be served
+		custom_json = '{"%s": %s' % (self._JS_GLOBALS_URL_VAR_NAME, static['ajax_views_json'])
+		if custom_vars:
+			custom_json = "%s, %s" % (custom_json, json.dumps(custom_vars)[1:])
 		else:
+			custom_json = "%s}" % custom_json
 
-			#  Make sure that a URL dict exists for the settings object
-			if self._JS_GLOBALS_URL_VAR_NAME not in self._custom_js_vars:
-				self._custom_js_vars[self._JS_GLOBALS_URL_VAR_NAME] = {}
-
-			#  Add the Ajax view name mapping to our context if it has not
-			#  already been built and added by the context
-			if not hasattr(CILCContext, '_ajax_views'):
-				CILCContext._ajax_views = {}
-				self._add_ajax_views_to_java_script(urlpatterns)
-			self._custom_js_vars[self._JS_GLOBALS_URL_VAR_NAME] = CILCContext._ajax_views
-
-		#  A list of JavaScript values and the variable names they should have
-		object_list = [
-			{
-				'object':   self._js_vars,
-				'var_name': self._JS_GLOBALS_OBJECT_NAME
-			},
-			{
-				'object':   self._js_settings_vars,
-				'var_name': self._JS_SETTINGS_OBJECT_NAME
-			},
-			{
-				'object':   self._custom_js_vars,
-				'var_name': self.js_globals_object
-			}
-		]
-
-		#  Add core and user-added variables by serializing the Python data as JSON
-		var_markup = []
-		for js_vars in object_list:
-			if js_vars['object']:
-				var_markup.append("%s = %s" % (js_vars['var_name'], json.dumps(js_vars['object'])))
-		global_markup.append("var %s;" % ",".join(var_markup))
-
-		global_markup.append("</script>")
-		return mark_safe("\n".join(global_markup))
+		var_markup = static['core_js'] + ["%s = %s" % (self.js_globals_object, custom_json)]
+		return mark_safe("\n".join([
+			"<script type='text/javascript'>",
+			"var %s;" % ",".join(var_markup),
+			"</script>"
+		]))
 
 	def _build_google_analytics_code(self):
 		"""
@@ -185,6 +422,18 @@ class CILCContext(object):
 		"""
 		return {}
 
+	def provide_lazy_context_variables(self):
+		"""
+		Add lazily evaluated variables to the template context.
+
+		This can be overridden by a child class that wishes to add variables
+		whose values are expensive to determine. Each key in the returned
+		dictionary will be the name of the variable, and each value will be a
+		function, taking no arguments, that returns the variable's value. The
+		function is only called if a template reads the variable.
+		"""
+		return {}
+
 	def provide_java_script_globals(self):
 		"""
 		Add global JavaScript variables.
@@ -196,27 +445,38 @@ class CILCContext(object):
 		"""
 		return {}
 
+	def _render_request_java_script_globals(self, static):
+		"""
+		Render the JavaScript global variables markup for the current request,
+		using the prerendered output in `static`.
+		"""
+		self._custom_js_vars = self.provide_java_script_globals()
+		return self._render_java_script_globals(static)
+
 	def build_context(self):
-		"""Create a dict of context variables that can be used in templates."""
+		"""
+		Create a dict of context variables that can be used in templates, whose
+		values are only determined when a template reads them.
+		"""
 
-		# Add paths to the site and its media
-		if self.request.is_secure():
-			self.app_media_url = self.app_media_url.replace('http:', 'https:')
-			self.shared_media_url = self.shared_media_url.replace('http:', 'https:')
-		paths = {
-			'GOOGLE_ANALYTICS': self._build_google_analytics_code(),
-			'MEDIA_URL':        self.app_media_url,
-			'REQUEST_PATH':     self.request.path,
-			'SHARED_MEDIA_URL': self.shared_media_url,
-			'SITE_URL':         Site.objects.get_current().domain
-		}
+		#  Add paths to the site and its media
+		static = self._get_static_output()
+		self.app_media_url = static['media_url']
+		self.shared_media_url = static['shared_media_url']
+		context = LazyContext()
+		context.add_value('GOOGLE_ANALYTICS', static['google_analytics'])
+		context.add_value('MEDIA_URL',        static['media_url'])
+		context.add_value('REQUEST_PATH',     self.request.path)
+		context.add_value('SHARED_MEDIA_URL', static['shared_media_url'])
+		context.add_value('SITE_URL',         static['site_url'])
 
 		#  Allows child classes to add context variables
-		paths.update(self.provide_context_variables())
+		context.add_lazy_values(self.provide_context_variables)
+		for name, provider in self.provide_lazy_context_variables().iteritems():
+			context.add_lazy_value(name, provider)
 
 		#  Add in our JavaScript global variables
-		self._build_javascript_globals()
-		self._custom_js_vars = self.provide_java_script_globals()
-		paths[self._JS_GLOBALS_CONTEXT_NAME] = self._render_java_script_globals()
+		context.add_lazy_value(self._JS_GLOBALS_CONTEXT_NAME, lambda: self._render_request_java_script_globals(static))
+		context.add_value(self._JS_GLOBALS_URL_CONTEXT_NAME, static['globals_url'])
 
-		return paths
+		return context
@@ -1,22 +1,174 @@
 
+from cilcdjango.core.ajax import ajax_views, ConcurrencyLimiter
+from cilcdjango.core.cache import AjaxResponseCache
 from cilcdjango.core.exceptions import AjaxError
 from cilcdjango.core.http import JsonResponse
 import cilcdjango.core.settings as _settings
 from cilcdjango.core.util import get_app_setting
 
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseRedirect
-from django.utils.encoding import force_unicode
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, QueryDict
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import parse_etags, quote_etag
+from django.utils.translation import ugettext as _
 
 from functools import wraps
 import inspect
 import re
+import simplejson as json
 
 #-------------------------------------------------------------------------------
 #  View Helpers
 #-------------------------------------------------------------------------------
 
-def ajax_view(view_function):
+_JSON_CONTENT_TYPE = "application/json"
+
+#  The most scripts that a memoized dynamic_js view keeps
+_MAX_MEMOIZED_SCRIPTS = 100
+
+def _make_bool_coercer():
+	"""
+	Return a function that converts a request value to a bool.
+
+	Since a bool value will make both bool("0") and bool("1") be true, the
+	value is converted to an int first if possible.
+	"""
+	def coerce_bool(value):
+		try:
+			value = int(value)
+		except (TypeError, ValueError):
+			pass
+		return bool(value)
+	return coerce_bool
+
+def _make_argument_coercers(view_function):
+	"""
+	Return a dict whose keys are the names of the keyword arguments of
+	`view_function` and whose values are functions that convert a request value
+	to the type of the argument's default value.
+	"""
+
+	#  Determine which function args are keyword arguments, based upon
+	#  getargspec returning a tuple with four values, where the first is the
+	#  list of function arguments and the last is a list of any default values.
+	arg_spec    = inspect.getargspec(view_function)
+	base_args   = arg_spec[0]
+	kw_defaults = arg_spec[3] or ()
+
+	coercers = {}
+	for name, default in zip(base_args[len(base_args) - len(kw_defaults):], kw_defaults):
+		if isinstance(default, bool):
+			coercers[name] = _make_bool_coercer()
+		elif default is None:
+			coercers[name] = lambda value: value
+		else:
+			coercers[name] = default.__class__
+	return coercers
+
+def _is_json_request(request):
+	"""Return True if the body of `request` is a JSON document."""
+	return request.META.get('CONTENT_TYPE', "").split(";")[0].strip() == _JSON_CONTENT_TYPE
+
+def _load_json_data(request):
+	"""
+	Return the JSON object in the body of `request` as a dict, raising an
+	AjaxError if it is not valid.
+	"""
+	try:
+		data = json.loads(request.raw_post_data or "{}")
+	except ValueError:
+		raise AjaxError(_("the request data is not valid JSON"))
+	if not isinstance(data, dict):
+		raise AjaxError(_("the request data must be a JSON object"))
+	return data
+
+def _json_data_to_query_dict(data):
+	"""
+	Return a mutable QueryDict containing the values of the JSON object `data`,
+	so that it can be used like form-encoded POST data by forms.
+	"""
+	query_dict = QueryDict("", mutable=True)
+	for key, value in data.iteritems():
+		values = value if isinstance(value, list) else [value]
+		query_dict.setlist(key, [
+			json.dumps(item) if isinstance(item, (dict, list)) else force_unicode(item)
+			for item in values if item is not None
+		])
+	return query_dict
+
+def _coerce_view_arguments(coercers, data, kwargs, consumed=None):
+	"""
+	Add a keyword argument to `kwargs` for each value in the dict-like `data`
+	whose key names one of the view's keyword arguments, converted by its
+	coercer from the `coercers` dict. The key of each converted value is added
+	to the `consumed` list, if one is given.
+	"""
+	for key, value in data.items():
+		coercer = coercers.get(key)
+		if coercer is not None:
+			try:
+				kwargs[str(key)] = coercer(value)
+			except (TypeError, ValueError):
+				pass
+			else:
+				if consumed is not None:
+					consumed.append(key)
+
+def _apply_view_arguments(request, coercers, kwargs):
+	"""
+	Add the view's keyword arguments found in the query string, POST data or
+	JSON body of `request` to `kwargs`, removing those found in the body from
+	the request's POST data.
+
+	The request's POST data is always replaced by a new, mutable QueryDict, so
+	the view can change it without affecting the original.
+	"""
+
+	#  Values from the query string can be overridden by those in the body
+	if request.GET:
+		_coerce_view_arguments(coercers, request.GET, kwargs)
+
+	#  A JSON body replaces the POST data, which will contain any of its values
+	#  not used as keyword arguments, so that forms created by the view can
+	#  use them like form-encoded data
+	if _is_json_request(request):
+		data = _load_json_data(request)
+		consumed = []
+		_coerce_view_arguments(coercers, data, kwargs, consumed)
+		for key in consumed:
+			del data[key]
+		request.POST = _json_data_to_query_dict(data)
+
+	#  Replace the POST data with a mutable QueryDict holding only the values
+	#  not converted to keyword arguments, so that they do not interfere with
+	#  forms created in the Ajax view, without deep-copying the original
+	else:
+		consumed = []
+		_coerce_view_arguments(coercers, request.POST, kwargs, consumed)
+		remaining = QueryDict("", mutable=True, encoding=request.POST.encoding)
+		for key, values in request.POST.lists():
+			if key not in consumed:
+				remaining.setlist(key, list(values))
+		request.POST = remaining
+
+def _make_busy_response():
+	"""
+	Return the 503 JSON response sent when a view with a concurrency limit is
+	too busy to handle a request, telling the client when to retry.
+	"""
+	retry_after = get_app_setting('AJAX_RETRY_AFTER')
+	response = JsonResponse({
+		'busy': True,
+		'error': _("The server is busy, please try again shortly"),
+		'retry_after': retry_after,
+		'success': False
+	}, status=503)
+	response['Retry-After'] = str(retry_after)
+	return response
+
+def ajax_view(view_function=None, cache=None, vary_on=None, max_concurrent=None, queue_timeout=0, shared_limit=False):
 	"""
 	Wrapper for Ajax views that handles shared logic.
 
@@ -32,56 +184,68 @@ def ajax_view(view_function):
 	the default values provided for the keyword argument. For example, the view
 	function `my_view(a, b=2, c=True)` would populate "b" with the value of
 	int(request.POST['b']) and "c" with the value of bool(request.POST['c']).
+
+	Keyword arguments can also be given in the query string, or in a JSON object
+	sent as the request body with an "application/json" content type. Values in
+	the JSON object that are not keyword arguments are made available to the
+	view as its request's POST data.
+
+	A view whose response depends only on its keyword arguments and on model
+	data can have its successful JSON responses cached by passing a timeout in
+	seconds as the `cache` keyword argument, and the models, querysets or
+	instances that it depends on as the `vary_on` list:
+
+	>>> @ajax_view(cache=60 * 5, vary_on=[MediaItem])
+	... def my_view(request, media_id=0):
+	...     pass
+
+	An expensive view can be limited to `max_concurrent` simultaneous
+	executions in each process, and across all processes if `shared_limit` is
+	True. A request waits for up to `queue_timeout` seconds for its turn,
+	after which it receives a 503 response whose JSON has a true "busy" value
+	and a "retry_after" value giving the seconds to wait before retrying.
 	"""
 
-	#  Determine which function args are keyword arguments, based upon
-	#  getargspec returning a tuple with four values, where the first is the
-	#  list of function arguments and the last is a list of any default values.
-	arg_spec     = inspect.getargspec(view_function)
-	base_args    = arg_spec[0]
-	kw_defaults  = arg_spec[3]
-	base_kw_args = base_args[0-len(kw_defaults):] if kw_defaults else []
-
-	def ajax_view(request, *args, **kwargs):
-
-		#  Get the response object from our function, as it will always be the
-		#  first positional argument, and search its POST data for values
-		#  matching the name of any of the decorated function's keyword args,
-		#  applying these to the kwargs for the function, while attempting to
-		#  convert the type of the POST value to match the default for the kwarg.
-		new_args = {}
-		non_arg_data = request.POST.copy()
-		for key, value in request.POST.iteritems():
-			if key in base_kw_args:
-
-				#  Since a bool value will make both bool("0") and bool("1")
-				#  be true, if we have a boolean kwarg, try to convert the
-				#  value to an int first
-				if type(kw_defaults[base_kw_args.index(key)]) == bool:
-					try:
-						value = int(value)
-					except ValueError:
-						pass
-
-				#  Perform the actual value casting. If we succeed, remove the
-				#  current value from the POST data, so that it does not
-				#  interfere with forms created in the Ajax view
-				try:
-					key_name = str(key)
-					new_args[key_name] = kw_defaults[base_kw_args.index(key)].__class__(value)
-				except ValueError:
-					pass
-				else:
-					del non_arg_data[key_name]
-		kwargs.update(new_args)
-		request.POST = non_arg_data
-
-		#  Get our view response and handle exceptions if we're debugging
+	#  Allow the decorator to be used with or without options
+	if view_function is None:
+		return lambda view_function: ajax_view(view_function, cache=cache, vary_on=vary_on,
+			max_concurrent=max_concurrent, queue_timeout=queue_timeout, shared_limit=shared_limit)
+
+	#  Work out how to convert each keyword argument once, when decorating
+	coercers = _make_argument_coercers(view_function)
+
+	view_name = "%s.%s" % (view_function.__module__, view_function.__name__)
+	response_cache = None
+	if cache:
+		response_cache = AjaxResponseCache(view_name, cache, vary_on)
+	limiter = None
+	if max_concurrent:
+		limiter = ConcurrencyLimiter(view_name, max_concurrent, queue_timeout, shared_limit)
+
+	def new_view(request, *args, **kwargs):
+
+		#  Get our view response and handle exceptions if we're debugging,
+		#  returning a cached copy of the response if one exists
 		view_success = True
 		error_message = u""
 		i_frame = False
+		cache_key = None
 		try:
-			response_data = view_function(request, *args, **kwargs)
+			_apply_view_arguments(request, coercers, kwargs)
+			if response_cache is not None:
+				cache_key = response_cache.make_key(request, kwargs)
+				cached = response_cache.get(cache_key)
+				if cached is not None:
+					return HttpResponse(cached[0], mimetype=cached[1])
+			if limiter is None:
+				response_data = view_function(request, *args, **kwargs)
+			elif limiter.acquire():
+				try:
+					response_data = view_function(request, *args, **kwargs)
+				finally:
+					limiter.release()
+			else:
+				return _make_busy_response()
 		except AjaxError, e:
 			view_success = False
 			error_message = force_unicode(e.message)
@@ -102,23 +266,96 @@ def ajax_view(view_function):
 			return response_data
 
 		#  Or make it a JSON response, adding in our predetermined success value
-		#  and a possible error text obtained from a caught AjaxError
+		#  and a possible error text obtained from a caught AjaxError, and
+		#  caching it if it was successful
 		else:
-			response_data['success'] = view_success
-			return JsonResponse(response_data, i_frame=i_frame)
+			response = JsonResponse(response_data, i_frame=i_frame, success=view_success)
+			if cache_key is not None and view_success:
+				response_cache.set(cache_key, response)
+			return response
 
-	#  Flag the Ajax view as such, for the sake of other cilcdjango functions
-	setattr(ajax_view, _settings.AJAX_VIEW_FLAG, True)
-	return wraps(view_function)(ajax_view)
+	#  Flag the Ajax view as such and register it, for the sake of other
+	#  cilcdjango functions
+	setattr(new_view, _settings.AJAX_VIEW_FLAG, True)
+	new_view = wraps(view_function)(new_view)
+	new_view.response_cache = response_cache
+	new_view.concurrency_limiter = limiter
+	ajax_views.register(new_view)
+	return new_view
 
-def dynamic_js(view_function):
+def dynamic_js(view_function=None, max_age=None, version=None, memoize=False):
 	"""
 	Wrapper that makes a view that returns JavaScript code provide an
 	appropriate MIME type.
+
+	Since such scripts usually only change when the project is deployed, the
+	response is given an ETag, and a conditional request whose ETag still
+	matches receives a 304 response. The ETag is computed from the script, or
+	from the result of the `version` function, which receives the view's
+	arguments, if one is given. A version function allows a 304 response to be
+	sent without generating the script at all.
+
+	If `max_age` is given, browsers may cache the script for that many seconds
+	without revalidating it. If `memoize` is True, the script generated for
+	each combination of arguments, version, language, request security and
+	user is kept, and all kept scripts are discarded once there are more than
+	_MAX_MEMOIZED_SCRIPTS of them. The options can be used as follows:
+
+	>>> @dynamic_js(max_age=60 * 60, version=lambda request: settings.MEDIA_VERSION)
+	... def my_script(request):
+	...     pass
+
 	"""
-	def new_view(*args, **kwargs):
-		return HttpResponse(view_function(*args, **kwargs), mimetype='text/javascript')
-	return new_view
+
+	#  Allow the decorator to be used with or without options
+	if view_function is None:
+		return lambda view_function: dynamic_js(view_function, max_age=max_age, version=version, memoize=memoize)
+
+	scripts = {}
+
+	def make_etag(value):
+		return md5_constructor(smart_str(value)).hexdigest()
+
+	def new_view(request, *args, **kwargs):
+
+		#  Answer a conditional request from the version alone if possible
+		etag = None
+		current_version = None
+		if version is not None:
+			current_version = version(request, *args, **kwargs)
+			etag = make_etag(current_version)
+			if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', "")):
+				return _make_js_response(HttpResponseNotModified(), etag, max_age)
+
+		#  Generate the script, or reuse the one generated for the arguments
+		script = None
+		if memoize:
+			user = getattr(request, 'user', None)
+			memo_key = (current_version, args, tuple(sorted(kwargs.items())),
+				getattr(request, 'LANGUAGE_CODE', None), request.is_secure(),
+				user.pk if user is not None and user.is_authenticated() else None)
+			script = scripts.get(memo_key)
+		if script is None:
+			script = view_function(request, *args, **kwargs)
+			if memoize:
+				if len(scripts) >= _MAX_MEMOIZED_SCRIPTS:
+					scripts.clear()
+				scripts[memo_key] = script
+
+		if etag is None:
+			etag = make_etag(script)
+			if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', "")):
+				return _make_js_response(HttpResponseNotModified(), etag, max_age)
+		return _make_js_response(HttpResponse(script, mimetype='text/javascript'), etag, max_age)
+
+	return wraps(view_function)(new_view)
+
+def _make_js_response(response, etag, max_age):
+	"""Add the caching headers for a dynamic_js view to `response`."""
+	response['ETag'] = quote_etag(etag)
+	if max_age is not None:
+		patch_cache_control(response, max_age=max_age)
+	return response
 
 def requires_secure(view_function):
 	"""
@@ -1,8 +1,11 @@
 
+from cilcdjango.core.media import merge_media
+
 from django import forms
 from django.forms.models import BaseModelFormSet
 from django.forms.util import ErrorList
 from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
@@ -32,6 +35,9 @@ class _FieldRenderer(object):
 		not_used   = "not-used"
 		required   = "required"
 
+	#  The most render plans and label texts kept for a form class
+	_MAX_RENDER_PLANS = 200
+
 	def __init__(self, form):
 		self._form = form
 		self._error_shown = False
@@ -59,63 +65,119 @@ class _FieldRenderer(object):
 				else:
 					self._field_classes[field] = self._field_classes[field][:index] + self._field_classes[field][index+1:]
 
-	def render_field(self, field):
-		"""Return HTML markup to render the requested field."""
+	def _get_render_plan(self, field, form_field):
+		"""
+		Return the render plan for the bound field `form_field` named `field`,
+		which is a dict of the parts of its markup that do not depend on its
+		label or on the data bound to the form.
+
+		The plan contains the field's base CSS classes, its container ID and the
+		classes of its container with and without the error class. Plans are
+		compiled once and shared by every instance of the form's class that
+		uses the same prefix, so rendering a field only needs to fill in its
+		labels, errors and widget. Once a class has _MAX_RENDER_PLANS plans,
+		they are discarded and compiled again as needed.
+		"""
 
-		form_field = self._form[field]
+		field_obj = form_field.field
+		field_classes = tuple(getattr(field_obj, 'field_classes', ()))
+		not_used = getattr(field_obj, 'not_used', False)
+		must_break = getattr(field_obj, 'must_break', False)
+		key = (field, self._form.prefix, self._form.auto_id, field_obj.required, not_used, must_break, field_classes)
+
+		cache = _get_class_cache(self._form.__class__, '_field_render_plans')
+		try:
+			return cache[key]
+		except KeyError:
+			pass
 
 		#  Customize the field's CSS classes
 		classes = [self.CSSClasses.field]
-		if form_field.errors:
-			classes.append(self.CSSClasses.errors)
-		if getattr(form_field.field, 'not_used', False):
+		if not_used:
 			classes.append(self.CSSClasses.not_used)
-		if form_field.field.required:
+		if field_obj.required:
 			classes.append(self.CSSClasses.required)
-		if getattr(form_field.field, 'must_break', False):
+		if must_break:
 			classes.append(self.CSSClasses.must_break)
-		if hasattr(form_field.field, 'field_classes'):
-			classes.extend(form_field.field.field_classes)
-
-		#  Add any custom field classes specified by the form
-		classes.extend(self._field_classes.get(field, []))
+		classes.extend(field_classes)
 
-		#  Build a class for the field container that takes the auto_id into
-		#  account, removes an initial id_ prefix, and transforms any
-		#  underscores into hyphens
-		field_name = form_field.html_name
+		#  Build the field container's ID from the auto_id, removing an initial
+		#  id_ prefix and transforming any underscores into hyphens
+		id_format = u"%s"
 		if self._form.auto_id:
 			try:
-				field_name = re.sub(r'^id_', '', self._form.auto_id) % field_name
+				id_format = re.sub(r'^id_', '', self._form.auto_id)
+				id_format % u""
 			except TypeError:
-				pass
-		field_name = field_name.replace('_', '-')
-
-		#  Build the beginning markup
-		form_markup = ["<div class='%s' id='%s-%s'>" % (" ".join(classes), self.CSSClasses.field, field_name)]
-		if form_field.errors:
-			form_markup.append(force_unicode(form_field.errors))
-		form_markup.append("<p class='%s'>" % self.CSSClasses.labels)
-
-		#  Get the label as a string, either from a proxy object or a unicode string
-		old_label = label_text = force_unicode(form_field.label)
+				id_format = u"%s"
+		container_id = "%s-%s" % (self.CSSClasses.field, (id_format % form_field.html_name).replace('_', '-'))
+
+		plan = {
+			'classes':           classes,
+			'container_id':      container_id,
+			'class_names':       " ".join(classes),
+			'error_class_names': " ".join(classes + [self.CSSClasses.errors])
+		}
+		if len(cache) >= self._MAX_RENDER_PLANS:
+			cache.clear()
+		cache[key] = plan
+		return plan
+
+	def _render_labels(self, form_field):
+		"""Return the markup between the errors and the widget of the bound field `form_field`."""
 
 		#  Title-case the label text, avoiding apparent acronyms, unless it
 		#  seems to have formatting of some sort already in it, as indicated by
-		#  a capitalized first letter.
-		if not re.search(r'^[A-Z]', label_text):
-			new_label = []
-			for l_part in re.split(r'\s+', label_text):
-				new_label.append(l_part.title() if not re.search(r'^[A-Z]{2,}', l_part) else l_part)
-			label_text = " ".join(new_label)
-		label_tag = form_field.label_tag(attrs={'class': self.CSSClasses.label})
-		if old_label != label_text:
-			label_tag = re.sub(r'>(\s+)?%s' % old_label, r'>%s' % label_text, label_tag)
-		form_markup.append(label_tag)
-
-		if form_field.help_text:
-			form_markup.append(form_field.label_tag(contents=form_field.help_text.capitalize(), attrs={'class': self.CSSClasses.help_text}))
-		form_markup.append("</p><div class=\"%s\">" % self.CSSClasses.inputs)
+		#  a capitalized first letter. The result is kept for the form's class.
+		label = force_unicode(form_field.label)
+		label_texts = _get_class_cache(self._form.__class__, '_field_label_texts')
+		label_text = label_texts.get(label)
+		if label_text is None:
+			label_text = label
+			if not re.search(r'^[A-Z]', label_text):
+				new_label = []
+				for l_part in re.split(r'\s+', label_text):
+					new_label.append(l_part.title() if not re.search(r'^[A-Z]{2,}', l_part) else l_part)
+				label_text = " ".join(new_label)
+			if len(label_texts) >= self._MAX_RENDER_PLANS:
+				label_texts.clear()
+			label_texts[label] = label_text
+
+		help_text = force_unicode(form_field.help_text)
+		labels_markup = ["<p class='%s'>" % self.CSSClasses.labels]
+		labels_markup.append(form_field.label_tag(contents=conditional_escape(label_text), attrs={'class': self.CSSClasses.label}))
+		if help_text:
+			labels_markup.append(form_field.label_tag(contents=help_text.capitalize(), attrs={'class': self.CSSClasses.help_text}))
+		labels_markup.append("</p><div class=\"%s\">" % self.CSSClasses.inputs)
+		return "\n".join(labels_markup)
+
+	def render_field(self, field, extra_classes=None):
+		"""
+		Return HTML markup to render the requested field, adding any CSS
+		classes in the `extra_classes` iterable to the field's container.
+		"""
+
+		form_field = self._form[field]
+		plan = self._get_render_plan(field, form_field)
+		errors = form_field.errors
+
+		#  Use the compiled container classes, unless there are custom classes
+		#  for this rendering
+		custom_classes = self._field_classes.get(field)
+		if custom_classes or extra_classes:
+			classes = list(plan['classes'])
+			if errors:
+				classes.append(self.CSSClasses.errors)
+			classes.extend(custom_classes or [])
+			classes.extend(extra_classes or [])
+			class_names = " ".join(classes)
+		else:
+			class_names = plan['error_class_names'] if errors else plan['class_names']
+
+		form_markup = ["<div class='%s' id='%s'>" % (class_names, plan['container_id'])]
+		if errors:
+			form_markup.append(force_unicode(errors))
+		form_markup.append(self._render_labels(form_field))
 		form_markup.append(force_unicode(form_field))
 		form_markup.append("</div></div>")
 
@@ -155,6 +217,13 @@ class _DjangoFormMixin(object):
 			pass
 		return _("a form error occurred")
 
+	def _get_field_media(self):
+		"""
+		Return the media used by the widgets of all of the form's fields, merged
+		in a single pass, as many fields often share the same media.
+		"""
+		return merge_media([field.widget.media for field in self.fields.values()])
+
 	def get_instance(self):
 		"""Return an instance only if the current form's instance has been saved."""
 		return self.instance if self.instance.pk else None
@@ -227,6 +296,8 @@ class _DjangoFormMixin(object):
 class DjangoForm(forms.Form, _DjangoFormMixin):
 	"""Base class for a non-model Django form."""
 
+	media = property(_DjangoFormMixin._get_field_media)
+
 	def __init__(self, *args, **kwargs):
 		super(DjangoForm, self).__init__(*args, **kwargs)
 		self.field = _FieldRenderer(self)
@@ -235,6 +306,8 @@ class DjangoForm(forms.Form, _DjangoFormMixin):
 class DjangoModelForm(forms.ModelForm, _DjangoFormMixin):
 	"""Base class for a Django form linked to a model."""
 
+	media = property(_DjangoFormMixin._get_field_media)
+
 	def __init__(self, *args, **kwargs):
 		super(DjangoModelForm, self).__init__(*args, **kwargs)
 		self.field = _FieldRenderer(self)
@@ -268,6 +341,19 @@ def form_bool(value):
 	else:
 		return bool(value)
 
+def _get_class_cache(klass, name):
+	"""
+	Return a dict stored as the attribute `name` defined directly on the class
+	`klass`, creating it if needed, so that a child class never shares the
+	cache of its parent.
+	"""
+	try:
+		return klass.__dict__[name]
+	except KeyError:
+		cache = {}
+		setattr(klass, name, cache)
+		return cache
+
 def _get_properties(obj):
 	"""
 	Return a tuple of the property / value pairs of a class's variables,
@@ -275,38 +361,73 @@ def _get_properties(obj):
 	"""
 	return [(prop, val) for prop, val in obj.__dict__.iteritems() if not prop.startswith("__")]
 
+def _get_custom_form_plan(form_class):
+	"""
+	Return a dict of the customizations made by the custom classes defined on
+	the form class `form_class`, which is compiled once for each class.
+
+	Its `replace_fields` value is a list of (field name, replacement field)
+	tuples, its `error_text` value is a list of (field name, error message
+	dict) tuples, and its `field_classes` value is a dict whose keys are field
+	names and whose values are lists of CSS classes for the field.
+	"""
+
+	cache = _get_class_cache(form_class, '_custom_form_plan')
+	try:
+		return cache['plan']
+	except KeyError:
+		pass
+
+	plan = {'replace_fields': [], 'error_text': [], 'field_classes': {}}
+
+	if hasattr(form_class, 'ReplaceFields'):
+		plan['replace_fields'] = _get_properties(form_class.ReplaceFields)
+
+	#  The error text classes can either have full dictionaries keyed by the
+	#  type of error raised, or a shorthand string, which will map to the
+	#  'required' error key.
+	if hasattr(form_class, 'ErrorText'):
+		for field, messages in _get_properties(form_class.ErrorText):
+			try:
+				messages = {'required': messages.strip()}
+			except AttributeError:
+				pass
+			plan['error_text'].append((field, messages))
+
+	if hasattr(form_class, 'FieldClasses'):
+		for field, classes in _get_properties(form_class.FieldClasses):
+			plan['field_classes'].setdefault(field, []).extend(classes)
+
+	cache['plan'] = plan
+	return plan
+
 def _initialize_custom_form(new_form):
 	"""
 	Initialize the form passed in `new_form`, which should harness the
 	_DjangoFormMixin mixin, using custom classes defined on the form to perform
 	the initialization and customization.
+
+	The custom classes are only inspected the first time that a form of a
+	given class is initialized, with later forms receiving the compiled
+	customizations.
 	"""
 
+	plan = _get_custom_form_plan(new_form.__class__)
+
 	#  Replace any fields specified with their replacements. The original values
 	#  of the field, derived from the model, will be preserved unless explicitly
 	#  specified in the field creation call.
-	if hasattr(new_form, 'ReplaceFields'):
-		for field, replace_with in _get_properties(new_form.ReplaceFields):
-			new_form.replace_field(field, replace_with)
-
-	#  Apply the error text to each field. This text is contained in and
-	#  ErrorText class, which will have class variables that can either be full
-	#  dictionaries keyed by the type of error raised, or a shorthand string,
-	#  which will map to the 'required' error key.
-	if hasattr(new_form, 'ErrorText'):
-		for field, messages in _get_properties(new_form.ErrorText):
-			try:
-				messages = {'required': messages.strip()}
-			except AttributeError:
-				pass
-			try:
-				new_form.fields[field].error_messages.update(messages)
-			except (AttributeError, KeyError):
-				pass
+	for field, replace_with in plan['replace_fields']:
+		new_form.replace_field(field, replace_with)
+
+	#  Apply the error text to each field
+	for field, messages in plan['error_text']:
+		try:
+			new_form.fields[field].error_messages.update(messages)
+		except (AttributeError, KeyError):
+			pass
 
-	#  Set any custom field classes, which are contained in the FieldClasses
-	#  class on the form, which will have class variables matching the name of a
-	#  field, and a value of an iterable containing class names
-	if hasattr(new_form, 'FieldClasses'):
-		for field, classes in _get_properties(new_form.FieldClasses):
-			new_form.add_field_classes(field, classes)
+	#  Set any custom field classes, giving the form's renderer its own copy of
+	#  each list, as these can be changed for a single form
+	for field, classes in plan['field_classes'].iteritems():
+		new_form.add_field_classes(field, classes)
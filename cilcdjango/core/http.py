@@ -1,7 +1,29 @@
-
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponse
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+
+#-------------------------------------------------------------------------------
+#  JSON Encoding
+#-------------------------------------------------------------------------------
+
+class _JsonEncoder(DjangoJSONEncoder):
+	"""A JSON encoder that also handles lazily translated strings."""
+
+	def default(self, obj):
+		if isinstance(obj, Promise):
+			return force_unicode(obj)
+		return super(_JsonEncoder, self).default(obj)
+
+_encoder = _JsonEncoder(separators=(',', ':'))
 
-import simplejson as json
+def encode_json(data):
+	"""Return `data` encoded as a single JSON string."""
+	return _encoder.encode(data)
+
+#-------------------------------------------------------------------------------
+#  Responses
+#-------------------------------------------------------------------------------
 
 class JsonResponse(HttpResponse):
 	"""A JSON-formatted HTTP response."""
@@ -12,17 +34,65 @@ class JsonResponse(HttpResponse):
 		be returned as the first argument.
 
 		This can accept an optional `i_frame` keyword argument, indicating that
-		the JSON response is going to be first received by an iframe element.
+		the JSON response is going to be first received by an iframe element,
+		and an optional `success` keyword argument giving the value of the
+		object's "success" key, which otherwise defaults to True if `data` does
+		not define it. The `data` dictionary itself is never modified.
 		"""
 
 		for_iframe = kwargs.pop('i_frame', False)
+		success = kwargs.pop('success', None)
 		if not for_iframe:
 			kwargs['mimetype'] = "application/json"
-		super(JsonResponse, self).__init__(*args, **kwargs)
-
-		#  Format the response as JSON, and, if the response is being embedded
-		#  in an i_frame, which can happen when uploading files via ajax, wrap
-		#  the content in a textarea
-		if 'success' not in data:
-			data['success'] = True
-		json.dump(data, fp=self)
+
+		#  Format the response as JSON in a single pass, adding the success
+		#  value to a copy of the data if it needs to be changed
+		if success is not None:
+			data = dict(data, success=success)
+		elif 'success' not in data:
+			data = dict(data, success=True)
+		super(JsonResponse, self).__init__(encode_json(data), *args, **kwargs)
+
+class StreamingJsonResponse(HttpResponse):
+	"""
+	A JSON-formatted HTTP response whose content is generated as it is sent,
+	for responses containing very large arrays.
+
+	The response is a JSON object containing the values in the `data` dict,
+	plus a "success" value of True, and an array under the name `key` whose
+	items are taken from the `items` iterable only as the response is sent.
+
+	>>> StreamingJsonResponse('media', (medium.title for medium in library.media.all()))
+
+	Since the content is not available until it is sent, this should not be
+	used for responses that middleware needs to read or alter.
+	"""
+
+	#  The number of array items encoded into each chunk of the response
+	_CHUNK_SIZE = 100
+
+	def __init__(self, key, items, data=None, *args, **kwargs):
+		kwargs['mimetype'] = "application/json"
+		head = dict(data or {})
+		head.setdefault('success', True)
+		head.pop(key, None)
+		super(StreamingJsonResponse, self).__init__(self._generate_chunks(key, items, head), *args, **kwargs)
+
+	def _generate_chunks(self, key, items, head):
+		"""Yield the JSON object in chunks, with its array last."""
+
+		encoded_head = encode_json(head)
+		yield "%s%s%s:[" % (encoded_head[:-1], "," if head else "", encode_json(key))
+
+		chunk = []
+		separator = ""
+		for item in items:
+			chunk.append(encode_json(item))
+			if len(chunk) >= self._CHUNK_SIZE:
+				yield separator + ",".join(chunk)
+				separator = ","
+				chunk = []
+		if chunk:
+			yield separator + ",".join(chunk)
+
+		yield "]}"
@@ -2,10 +2,14 @@
 from cilcdjango.core.util import get_app_setting
 
 from django import forms
+from django.utils.datastructures import SortedDict
 
 import os
 import re
 
+#  The request attribute that holds the media collected for preloading
+_PRELOAD_ATTRIBUTE = "_cilc_preload_media"
+
 #-------------------------------------------------------------------------------
 #  Media Functions
 #-------------------------------------------------------------------------------
@@ -23,10 +27,122 @@ def make_secure_media_url(url):
 	"""Return secure version of the given media URL."""
 	return re.sub(r'^http:', 'https:', url)
 
+def merge_media(media_list):
+	"""
+	Return a Django Media instance containing every file in the Media instances
+	in the `media_list` iterable, in the order in which each file first occurs.
+
+	Adding Media instances together checks each new file against every file
+	already added, so this is used instead for large numbers of them, such as
+	the identical media of the many widgets in a long form.
+	"""
+
+	css = {}
+	js = []
+	seen_css = {}
+	seen_js = set()
+	for media in media_list:
+		for path in media._js:
+			if path not in seen_js:
+				seen_js.add(path)
+				js.append(path)
+		for medium, paths in media._css.iteritems():
+			medium_seen = seen_css.setdefault(medium, set())
+			for path in paths:
+				if path not in medium_seen:
+					medium_seen.add(path)
+					css.setdefault(medium, []).append(path)
+
+	merged = forms.Media()
+	merged._css = css
+	merged._js = js
+	return merged
+
+#-------------------------------------------------------------------------------
+#  Preloading
+#-------------------------------------------------------------------------------
+
+def add_preload_media(request, url, media_type):
+	"""
+	Record that the page being rendered for `request` uses the media file at the
+	absolute URL `url`, whose `media_type` is either "script" or "style", so
+	that the browser can be told to preload it.
+	"""
+	if request is None:
+		return
+	preload = getattr(request, _PRELOAD_ATTRIBUTE, None)
+	if preload is None:
+		preload = SortedDict()
+		setattr(request, _PRELOAD_ATTRIBUTE, preload)
+	if url not in preload:
+		preload[url] = media_type
+
+def add_preload_media_collection(request, media):
+	"""
+	Record every file in the Django Media instance `media` as preloadable media
+	for the page being rendered for `request`.
+	"""
+	if request is None:
+		return
+	css_files = [path for medium in sorted(media._css) for path in media._css[medium]]
+	secure = request.is_secure()
+	for media_type, files in (('style', css_files), ('script', media._js)):
+		for path in files:
+			url = media.absolute_path(path)
+			if secure:
+				url = make_secure_media_url(url)
+			add_preload_media(request, url, media_type)
+
+def get_preload_media(request):
+	"""
+	Return a list of (url, media_type) tuples for the media recorded for the
+	page rendered for `request`, in the order in which it was first used.
+	"""
+	return getattr(request, _PRELOAD_ATTRIBUTE, SortedDict()).items()
+
 #-------------------------------------------------------------------------------
 #  Media Classes
 #-------------------------------------------------------------------------------
 
+def _urls_for_media_list(file_list):
+	"""
+	Transform a list of media references into absolute URLs pointing to the
+	shared media URL.
+	"""
+	return tuple([make_shared_media_url(file_path) for file_path in file_list])
+
+def _install_shared_media(cls):
+	"""
+	Replace the `media` property of the class `cls` with one that merges the
+	media in the class's SharedMedia class, whose URLs are only built once for
+	the class, with the media that the class would otherwise have.
+	"""
+
+	#  Find the media property that Django's metaclass gave the class
+	base_media = None
+	for klass in cls.__mro__:
+		if 'media' in klass.__dict__:
+			base_media = klass.__dict__['media']
+			break
+
+	shared_media = None
+	if hasattr(cls, 'SharedMedia'):
+		new_css = {}
+		for media_type in getattr(cls.SharedMedia, 'css', {}):
+			new_css[media_type] = _urls_for_media_list(cls.SharedMedia.css[media_type])
+		shared_media = forms.Media(css=new_css, js=_urls_for_media_list(getattr(cls.SharedMedia, 'js', ())))
+
+	def _get_media(self):
+		media = base_media.__get__(self, cls) if base_media is not None else forms.Media()
+		if shared_media is None:
+			return media
+		if not media._js and not media._css:
+			return shared_media
+		return merge_media([shared_media, media])
+
+	cls.media = property(_get_media)
+	cls._shared_media_class = cls
+
 class SharedMediaMixin(object):
 	"""
 	A mixin for any form, field or widget that defines a SharedMedia class whose
@@ -35,46 +151,13 @@ class SharedMediaMixin(object):
 	The media specified in this special SharedMedia class will be merged into
 	the media definition for the object using this mixin and available as
 	absolute URLs.
-	"""
 
-	def _urls_for_media_list(self, file_list):
-		"""
-		Transform a list of media references into absolute URLs pointing to the
-		shared media URL.
-		"""
-
-		new_files = []
-		for file_path in file_list:
-			new_files.append(make_shared_media_url(file_path))
-		return tuple(new_files)
-
-	def __getattribute__(self, attr):
-		"""
-		If the `media` attribute of the class using this mixin is being
-		accessed, combine the shared media values with the media available
-		through the class' Media class.
-		"""
-
-		value = super(SharedMediaMixin, self).__getattribute__(attr)
-
-		#  If we are requesting media, merge our shared media files with the
-		#  media base, then cache them for quicker access in the future
-		if attr == 'media':
-			if hasattr(self, '_shared_media'):
-				return self._shared_media
-			else:
-
-				if hasattr(self, 'SharedMedia'):
-					new_css = {}
-					for media_type in getattr(self.SharedMedia, 'css', {}):
-						new_css[media_type] = self._urls_for_media_list(self.SharedMedia.css[media_type])
-					new_js = self._urls_for_media_list(getattr(self.SharedMedia, 'js', ()))
-					new_media = forms.Media(css=new_css, js=new_js) + value
-
-				else:
-					new_media = value
-
-				self._shared_media = new_media
-				return new_media
+	The `media` property of each class using this mixin is replaced the first
+	time that the class is instantiated, so that the shared media is built once
+	per class rather than once per object.
+	"""
 
-		return value
+	def __new__(cls, *args, **kwargs):
+		if cls.__dict__.get('_shared_media_class') is not cls:
+			_install_shared_media(cls)
+		return super(SharedMediaMixin, cls).__new__(cls)
@@ -3,113 +3,483 @@
 # Modified by: Shwagroo Team
 # Modified further by: Justin Locsei
 
-import sys
-import os
+import cProfile
+import logging
+import marshal
+import pstats
 import re
-import hotshot, hotshot.stats
-import tempfile
 import StringIO
+import time
 
-from django.conf import settings
+from cilcdjango.core.media import get_preload_media
+from cilcdjango.core.profiling import (
+	acquire_memory_tracing, format_memory_statistics, get_view_name, memory_snapshots,
+	release_memory_tracing, request_watchdog, stack_sampler, start_request_timing, stop_request_timing, take_memory_snapshot
+)
+from cilcdjango.core.util import get_app_setting
 
-words_re = re.compile( r'\s+' )
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+from django.utils.html import escape
 
 group_prefix_re = [
-    re.compile( "^.*/django/[^/]+" ),
-    re.compile( "^(.*)/[^/]+$" ), # extract module path
-    re.compile( ".*" ),           # catch strange entries
+	re.compile("^.*/django/[^/]+"),
+	re.compile("^(.*)/[^/]+$"), # extract module path
+	re.compile(".*"),           # catch strange entries
 ]
 
 class ProfileMiddleware(object):
-    """
-    Displays hotshot profiling for any view.
-    http://yoursite.com/yourview/?prof
+	"""
+	Displays cProfile profiling for any view.
+	http://yoursite.com/yourview/?prof
+
+	Add the "prof" key to query string by appending ?prof (or &prof=)
+	and you'll see the profiling results in your browser. The following
+	query string values change what is shown:
+
+		sort     - the pstats sort key(s), comma-separated, such as "cumulative"
+		limit    - the number of functions to list, defaulting to 40
+		callers  - a regex for functions whose callers should be listed
+		callees  - a regex for functions whose callees should be listed
+
+	Using ?prof=pstats instead downloads the raw stats, which can be loaded
+	with the pstats module, while ?prof=callgrind downloads them in a format
+	that can be opened with KCachegrind.
+
+	It's set up to only be available in django's debug mode, is available for superuser otherwise,
+	but you really shouldn't add this middleware to any production configuration.
+
+	The profiler is kept on the request, so concurrent requests to a threaded
+	server are each profiled separately.
+	"""
+
+	_PROFILER_ATTRIBUTE = "_cilc_profiler"
+
+	_SORT_KEYS = frozenset([
+		'calls', 'cumulative', 'cumtime', 'file', 'filename', 'line', 'module',
+		'name', 'ncalls', 'nfl', 'pcalls', 'stdname', 'time', 'tottime'
+	])
+	_DEFAULT_SORT = ('time', 'calls')
+	_DEFAULT_LIMIT = 40
+
+	#  Callgrind costs are given in microseconds
+	_CALLGRIND_SCALE = 1000000
+
+	def _is_profiling(self, request):
+		"""Return True if the profiling results have been requested for `request`."""
+		if 'prof' not in request.GET:
+			return False
+		user = getattr(request, 'user', None)
+		return settings.DEBUG or (user is not None and user.is_superuser)
+
+	def process_request(self, request):
+		if self._is_profiling(request):
+			setattr(request, self._PROFILER_ATTRIBUTE, cProfile.Profile())
+
+	def process_view(self, request, callback, callback_args, callback_kwargs):
+		profiler = getattr(request, self._PROFILER_ATTRIBUTE, None)
+		if profiler is not None:
+			return profiler.runcall(callback, request, *callback_args, **callback_kwargs)
+
+	def get_group(self, file):
+		for g in group_prefix_re:
+			name = g.findall(file)
+			if name:
+				return name[0]
+
+	def get_summary(self, results_dict, sum):
+		list = [(item[1], item[0]) for item in results_dict.items()]
+		list.sort(reverse=True)
+		list = list[:40]
+
+		res = "      tottime\n"
+		for item in list:
+			res += "%4.1f%% %7.3f %s\n" % (100*item[0]/sum if sum else 0, item[0], escape(item[1]))
+
+		return res
+
+	def summary_for_files(self, stats):
+		"""Return markup summarizing the time spent in each file and group of files."""
+
+		mystats = {}
+		mygroups = {}
+
+		sum = 0
+
+		for (file, line, name), (cc, nc, time, ct, callers) in stats.stats.iteritems():
+			sum += time
+
+			if not file in mystats:
+				mystats[file] = 0
+			mystats[file] += time
+
+			group = self.get_group(file)
+			if not group in mygroups:
+				mygroups[group] = 0
+			mygroups[group] += time
+
+		return "<pre>" + \
+		       " ---- By file ----\n\n" + self.get_summary(mystats, sum) + "\n" + \
+		       " ---- By group ---\n\n" + self.get_summary(mygroups, sum) + \
+		       "</pre>"
+
+	def _get_sort_keys(self, request):
+		"""Return the valid pstats sort keys requested for `request`."""
+		keys = [key for key in request.GET.get('sort', "").split(",") if key in self._SORT_KEYS]
+		return keys or self._DEFAULT_SORT
+
+	def _get_limit(self, request):
+		"""Return the number of functions to list for `request`."""
+		try:
+			return max(int(request.GET.get('limit', self._DEFAULT_LIMIT)), 1)
+		except ValueError:
+			return self._DEFAULT_LIMIT
+
+	def _make_download(self, content, filename):
+		"""Return a response that downloads `content` as a file called `filename`."""
+		response = HttpResponse(content, mimetype="application/octet-stream")
+		response['Content-Disposition'] = "attachment; filename=%s" % filename
+		return response
+
+	def stats_to_callgrind(self, stats):
+		"""Return the pstats.Stats instance `stats` in the callgrind format."""
+
+		#  pstats records each function's callers, while callgrind lists the
+		#  functions that each function calls, so the relations are inverted
+		callees = {}
+		for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+			for caller, caller_stats in callers.iteritems():
+				callees.setdefault(caller, []).append((func, caller_stats))
+
+		scale = self._CALLGRIND_SCALE
+		lines = ["events: Microseconds"]
+		for func, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+			file, line, name = func
+			lines.extend(["", "fl=%s" % file, "fn=%s" % name, "%d %d" % (line, tt * scale)])
+			for callee, callee_stats in callees.get(func, []):
+
+				#  Callers recorded by cProfile are 4-tuples, while those of a
+				#  profile.Profile are simply a call count
+				if isinstance(callee_stats, tuple):
+					calls, callee_time = callee_stats[0], callee_stats[3]
+				else:
+					calls, callee_time = callee_stats, 0
+				lines.extend([
+					"cfl=%s" % callee[0],
+					"cfn=%s" % callee[2],
+					"calls=%d %d" % (calls, callee[1]),
+					"%d %d" % (line, callee_time * scale)
+				])
+		lines.append("")
+		return "\n".join(lines)
+
+	def render_stats(self, request, stats):
+		"""Return markup showing the profiling results in `stats` for `request`."""
+
+		out = StringIO.StringIO()
+		stats.stream = out
+		stats.sort_stats(*self._get_sort_keys(request))
+		limit = self._get_limit(request)
+		stats.print_stats(limit)
+		for option, printer in (('callers', stats.print_callers), ('callees', stats.print_callees)):
+			pattern = request.GET.get(option)
+			if pattern:
+				printer(pattern, limit)
+		return "<pre>" + escape(out.getvalue()) + "</pre>" + self.summary_for_files(stats)
+
+	def process_response(self, request, response):
+		profiler = getattr(request, self._PROFILER_ATTRIBUTE, None)
+		if profiler is None:
+			return response
+		delattr(request, self._PROFILER_ATTRIBUTE)
+
+		stats = pstats.Stats(profiler)
+		output = request.GET.get('prof')
+		if output == "pstats":
+			return self._make_download(marshal.dumps(stats.stats), "profile.pstats")
+		elif output == "callgrind":
+			return self._make_download(self.stats_to_callgrind(stats), "callgrind.out.profile")
+		else:
+			return HttpResponse(self.render_stats(request, stats))
+
+class PreloadMediaMiddleware(object):
+	"""
+	Adds a `Link` header to HTML responses that tells the browser to preload
+	the CSS and JavaScript files used by the page.
+
+	The media is collected while the page renders, both from the media tags in
+	the cilc_tags library and from the forms passed to a DjangoPage, so the
+	browser can begin fetching large files such as CKEditor's before it has
+	parsed the page's markup.
+
+	If the CILC_PRELOAD_EARLY_HINTS setting is True and the WSGI server offers
+	an early hints callable as the `wsgi.early_hints` environment value, the
+	links last sent for a path are also sent as a 103 Early Hints response as
+	soon as a new request for that path reaches its view.
+	"""
+
+	_EARLY_HINTS_ENVIRON_KEY = "wsgi.early_hints"
+	_EARLY_HINTS_CACHE_PREFIX = "cilc:early_hints"
+	_EARLY_HINTS_TIMEOUT = 60 * 60 * 24
+
+	def _early_hints_key(self, request):
+		"""Return the cache key of the links remembered for the request's path."""
+		return "%s:%s" % (self._EARLY_HINTS_CACHE_PREFIX, md5_constructor(smart_str(request.path)).hexdigest())
+
+	def _make_link_header(self, media):
+		"""Return the Link header value for the (url, media_type) tuples in `media`."""
+		return ", ".join(["<%s>; rel=preload; as=%s" % (url, media_type) for url, media_type in media])
+
+	def process_view(self, request, callback, callback_args, callback_kwargs):
+		"""Send any links remembered for the requested path as early hints."""
+		if get_app_setting('PRELOAD_EARLY_HINTS'):
+			send_hints = request.META.get(self._EARLY_HINTS_ENVIRON_KEY)
+			if callable(send_hints):
+				links = cache.get(self._early_hints_key(request))
+				if links:
+					send_hints([('Link', links)])
+		return None
+
+	def process_response(self, request, response):
+		"""Add the preload links for the page's media to an HTML response."""
+
+		media = get_preload_media(request)
+		if not media or response.status_code != 200 or not response.get('Content-Type', '').startswith('text/html'):
+			return response
+
+		links = self._make_link_header(media)
+		if response.has_header('Link'):
+			response['Link'] = "%s, %s" % (response['Link'], links)
+		else:
+			response['Link'] = links
+
+		if get_app_setting('PRELOAD_EARLY_HINTS'):
+			cache.set(self._early_hints_key(request), links, self._EARLY_HINTS_TIMEOUT)
+
+		return response
+
+class SamplingProfilerMiddleware(object):
+	"""
+	Records statistical samples of the call stack of every view, aggregated by
+	view name, using the process-wide sampler in `cilcdjango.core.profiling`.
+
+	Unlike the ProfileMiddleware, this has a low enough overhead to be left on
+	in production. The collected samples can be downloaded as collapsed stacks,
+	ready to be turned into a flame graph, from the `cilc-sampling-profile`
+	view, which is only available to superusers.
+	"""
+
+	def __init__(self):
+		stack_sampler.start()
+
+	def process_view(self, request, callback, callback_args, callback_kwargs):
+		stack_sampler.register_thread(get_view_name(callback))
+		return None
+
+	def process_exception(self, request, exception):
+		stack_sampler.unregister_thread()
+		return None
+
+	def process_response(self, request, response):
+		stack_sampler.unregister_thread()
+		return response
+
+class ServerTimingMiddleware(object):
+	"""
+	Reports how long the parts of each request took in a `Server-Timing`
+	header, which browsers show alongside the request in their developer tools.
+
+	The total and view times are always recorded. The number and duration of
+	database queries are recorded when the connections already log them, as
+	they do in debug mode, or when the CILC_SERVER_TIMING_QUERIES setting is
+	True, which makes them log the queries of each request. Time spent
+	rendering a DjangoPage's template, querying LDAP and rendering media items
+	is recorded by the `timed` helper in `cilcdjango.core.profiling`, which any
+	other code can use to add its own named timings.
+
+	The header is only added for superusers or in debug mode, unless the
+	CILC_SERVER_TIMING_PUBLIC setting is True. If the CILC_SERVER_TIMING_LOG
+	setting is True, the timings of every request are also logged to the
+	"cilcdjango.timing" logger.
+	"""
+
+	_STATE_ATTRIBUTE = "_cilc_server_timing"
+
+	logger = logging.getLogger("cilcdjango.timing")
+
+	def process_request(self, request):
+
+		#  Database queries are only logged in debug mode unless the connection
+		#  is told otherwise, which it only is for the length of the request if
+		#  query timings have been asked for
+		force_queries = get_app_setting('SERVER_TIMING_QUERIES')
+		debug_cursors = {}
+		query_counts = {}
+		for conn in connections.all():
+			if force_queries and not conn.use_debug_cursor:
+				debug_cursors[conn.alias] = conn.use_debug_cursor
+				conn.use_debug_cursor = True
+			if settings.DEBUG or conn.use_debug_cursor:
+				query_counts[conn.alias] = len(conn.queries)
+
+		setattr(request, self._STATE_ATTRIBUTE, {
+			'start': time.time(),
+			'debug_cursors': debug_cursors,
+			'query_counts': query_counts
+		})
+		start_request_timing()
+
+	def process_view(self, request, callback, callback_args, callback_kwargs):
+		state = getattr(request, self._STATE_ATTRIBUTE, None)
+		if state is not None:
+			state['view_start'] = time.time()
+		return None
+
+	def _show_header(self, request):
+		"""Return True if the timings should be sent to the client making `request`."""
+		if settings.DEBUG or get_app_setting('SERVER_TIMING_PUBLIC'):
+			return True
+		user = getattr(request, 'user', None)
+		return user is not None and user.is_superuser
 
-    Add the "prof" key to query string by appending ?prof (or &prof=)
-    and you'll see the profiling results in your browser.
-    It's set up to only be available in django's debug mode, is available for superuser otherwise,
-    but you really shouldn't add this middleware to any production configuration.
+	def _format_metric(self, name, duration, description):
+		"""Return a Server-Timing metric for a `duration` given in seconds."""
+		metric = "%s;dur=%.1f" % (re.sub(r'[^\w.-]', "_", name), duration * 1000)
+		if description:
+			metric += ';desc="%s"' % description.replace('"', "'")
+		return metric
 
-    WARNING: It uses hotshot profiler which is not thread safe.
-    """
-    def process_request(self, request):
-        if (settings.DEBUG or request.user.is_superuser) and 'prof' in request.GET:
-            self.tmpfile = tempfile.mktemp()
-            self.prof = hotshot.Profile(self.tmpfile)
+	def process_response(self, request, response):
+		state = getattr(request, self._STATE_ATTRIBUTE, None)
+		timer = stop_request_timing()
+		if state is None:
+			return response
+		delattr(request, self._STATE_ATTRIBUTE)
+		now = time.time()
 
-    def process_view(self, request, callback, callback_args, callback_kwargs):
-        if (settings.DEBUG or request.user.is_superuser) and 'prof' in request.GET:
-            return self.prof.runcall(callback, request, *callback_args, **callback_kwargs)
+		#  Total the queries made since the request began by the connections
+		#  that log them, restoring any connection whose logging was forced
+		query_count = 0
+		query_time = 0
+		try:
+			for conn in connections.all():
+				if conn.alias in state['query_counts']:
+					queries = conn.queries[state['query_counts'][conn.alias]:]
+					query_count += len(queries)
+					query_time += sum([float(query.get('time') or 0) for query in queries])
+		finally:
+			for conn in connections.all():
+				if conn.alias in state['debug_cursors']:
+					conn.use_debug_cursor = state['debug_cursors'][conn.alias]
+		if timer is None:
+			return response
 
-    def get_group(self, file):
-        for g in group_prefix_re:
-            name = g.findall( file )
-            if name:
-                return name[0]
+		metrics = [('total', now - state['start'], None, 1)]
+		if state['query_counts']:
+			metrics.append(('db', query_time, "%d queries" % query_count, query_count))
+		if 'view_start' in state:
+			metrics.append(('view', now - state['view_start'], None, 1))
+		for name, timing in timer.timings.iteritems():
+			metrics.append((name, timing['duration'], timing['description'], timing['count']))
 
-    def get_summary(self, results_dict, sum):
-        list = [ (item[1], item[0]) for item in results_dict.items() ]
-        list.sort( reverse = True )
-        list = list[:40]
+		if self._show_header(request):
+			response['Server-Timing'] = ", ".join([self._format_metric(*metric[:3]) for metric in metrics])
 
-        res = "      tottime\n"
-        for item in list:
-            res += "%4.1f%% %7.3f %s\n" % ( 100*item[0]/sum if sum else 0, item[0], item[1] )
+		if get_app_setting('SERVER_TIMING_LOG'):
+			self.logger.info("%s %s %d %s" % (request.method, request.path, response.status_code,
+				" ".join(["%s=%.1fms/%d" % (name, duration * 1000, count) for name, duration, description, count in metrics])))
 
-        return res
+		return response
 
-    def summary_for_files(self, stats_str):
-        stats_str = stats_str.split("\n")[5:]
+class MemoryProfileMiddleware(object):
+	"""
+	Displays the memory allocated by any view, using tracemalloc.
+	http://yoursite.com/yourview/?memprof
 
-        mystats = {}
-        mygroups = {}
+	Add the "memprof" key to the query string and you'll see the allocation
+	sites holding the most memory after the view ran, followed by those that
+	grew the most while it ran. Like the ProfileMiddleware, this is only
+	available in debug mode or to superusers.
 
-        sum = 0
+	If the CILC_MEMORY_SNAPSHOTS setting is True, allocations are instead
+	traced all the time, and a snapshot is compared with the last one for the
+	same view after every CILC_MEMORY_PROFILER_INTERVAL requests to it. The
+	latest comparison for each view is shown by the `cilc-memory-profile` view.
 
-        for s in stats_str:
-            fields = words_re.split(s);
-            if len(fields) == 7:
-                time = float(fields[2])
-                sum += time
-                file = fields[6].split(":")[0]
+	tracemalloc is part of the standard library from Python 3.4. On Python 2
+	it needs the pytracemalloc backport, and without it this does nothing.
+	"""
 
-                if not file in mystats:
-                    mystats[file] = 0
-                mystats[file] += time
+	_SNAPSHOT_ATTRIBUTE = "_cilc_memory_snapshot"
 
-                group = self.get_group(file)
-                if not group in mygroups:
-                    mygroups[ group ] = 0
-                mygroups[ group ] += time
+	def __init__(self):
+		if get_app_setting('MEMORY_SNAPSHOTS'):
+			memory_snapshots.start()
 
-        return "<pre>" + \
-               " ---- By file ----\n\n" + self.get_summary(mystats,sum) + "\n" + \
-               " ---- By group ---\n\n" + self.get_summary(mygroups,sum) + \
-               "</pre>"
+	def _is_profiling(self, request):
+		"""Return True if the memory profile has been requested for `request`."""
+		if 'memprof' not in request.GET:
+			return False
+		user = getattr(request, 'user', None)
+		return settings.DEBUG or (user is not None and user.is_superuser)
 
-    def process_response(self, request, response):
-        if (settings.DEBUG or request.user.is_superuser) and 'prof' in request.GET:
-            self.prof.close()
+	def process_view(self, request, callback, callback_args, callback_kwargs):
+		request._cilc_view_name = get_view_name(callback)
+		if self._is_profiling(request):
+			if not acquire_memory_tracing():
+				return HttpResponse("<pre>tracemalloc is not available</pre>")
+			setattr(request, self._SNAPSHOT_ATTRIBUTE, take_memory_snapshot())
+		return None
 
-            out = StringIO.StringIO()
-            old_stdout = sys.stdout
-            sys.stdout = out
+	def summary_for_snapshots(self, before, after):
+		"""Return markup comparing the tracemalloc snapshots `before` and `after` a view."""
+		limit = get_app_setting('MEMORY_PROFILER_LIMIT')
+		return "<pre>" + \
+		       " ---- Top allocation sites ----\n\n" + escape(format_memory_statistics(after.statistics('lineno'), limit)) + "\n" + \
+		       " ---- Growth by line ----\n\n" + escape(format_memory_statistics(after.compare_to(before, 'lineno'), limit)) + "\n" + \
+		       " ---- Growth by file ----\n\n" + escape(format_memory_statistics(after.compare_to(before, 'filename'), limit)) + \
+		       "</pre>"
 
-            stats = hotshot.stats.load(self.tmpfile)
-            stats.sort_stats('time', 'calls')
-            stats.print_stats()
+	def process_response(self, request, response):
+		before = getattr(request, self._SNAPSHOT_ATTRIBUTE, None)
+		if before is not None:
+			delattr(request, self._SNAPSHOT_ATTRIBUTE)
+			try:
+				after = take_memory_snapshot()
+			finally:
+				release_memory_tracing()
+			return HttpResponse(self.summary_for_snapshots(before, after))
 
-            sys.stdout = old_stdout
-            stats_str = out.getvalue()
+		view_name = getattr(request, '_cilc_view_name', None)
+		if view_name is not None:
+			memory_snapshots.record(view_name)
+		return response
 
-            if response and response.content and stats_str:
-                response.content = "<pre>" + stats_str + "</pre>"
+class SlowRequestWatchdogMiddleware(object):
+	"""
+	Reports requests that take longer than CILC_WATCHDOG_THRESHOLD seconds,
+	along with stacks of the worker thread captured while they ran, using the
+	process-wide watchdog in `cilcdjango.core.profiling`.
 
-            response.content = "\n".join(response.content.split("\n")[:40])
+	A report is written even if the request never finishes, which makes it
+	possible to see where a hung worker is stuck, such as in an LDAP bind.
+	"""
 
-            response.content += self.summary_for_files(stats_str)
+	def __init__(self):
+		request_watchdog.start()
 
-            os.unlink(self.tmpfile)
+	def process_view(self, request, callback, callback_args, callback_kwargs):
+		request_watchdog.register_request(request, get_view_name(callback), callback_args, callback_kwargs)
+		return None
 
-        return response
+	def process_exception(self, request, exception):
+		request_watchdog.unregister_request()
+		return None
 
+	def process_response(self, request, response):
+		request_watchdog.unregister_request()
+		return response
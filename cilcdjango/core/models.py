@@ -5,6 +5,9 @@ from django.utils.encoding import force_unicode
 from cilcdjango.core.fields import RichTextEditorField
 from cilcdjango.core.text import smart_slugify
 
+#  Connects the signal receivers that invalidate cached fragments
+import cilcdjango.core.cache
+
 def _get_field(instance, name):
 	"""
 	Get the attribute named `name` on the model instance `instance` and error
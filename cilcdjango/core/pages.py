@@ -1,8 +1,11 @@
 
+from cilcdjango.core.media import add_preload_media_collection, merge_media
+from cilcdjango.core.profiling import timed
+
 from django import forms
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.template.loader import render_to_string
+from django.template.loader import get_template, render_to_string
 
 import os
 
@@ -31,8 +34,9 @@ class DjangoPage(object):
 	def __init__(self, request, *args, **kwargs):
 		"""Requires the Request instance as its first argument."""
 
-		self.request     = request
+		self.request      = request
 		self._render_args = {}
+		self._page_media  = None
 		self.configure_page(*args, **kwargs)
 
 	def configure_page(self, *args, **kwargs):
@@ -48,12 +52,31 @@ class DjangoPage(object):
 		return {}
 
 	def _combine_form_media(self):
-		"""Combine the media used by all forms in the render arguments."""
-		all_media = forms.Media()
-		for render_arg in self._render_args.values():
-			if hasattr(render_arg, 'media'):
-				all_media += render_arg.media
-		return all_media
+		"""
+		Combine the media used by all forms in the render arguments.
+
+		Media with the same files is only merged once, so a page showing several
+		forms with identical media only includes it once. The combined media is
+		kept on the page until the files used by its render arguments change.
+		"""
+
+		media_list = []
+		media_keys = []
+		seen_keys = set()
+		for render_arg in self._render_args.itervalues():
+			media = getattr(render_arg, 'media', None)
+			if not isinstance(media, forms.Media):
+				continue
+			media_key = (tuple(media._js), tuple(sorted([(medium, tuple(paths)) for medium, paths in media._css.iteritems()])))
+			if media_key not in seen_keys:
+				seen_keys.add(media_key)
+				media_keys.append(media_key)
+				media_list.append(media)
+
+		key = tuple(media_keys)
+		if self._page_media is None or self._page_media[0] != key:
+			self._page_media = (key, merge_media(media_list))
+		return self._page_media[1]
 
 	def resolve_template_path(self, template_name):
 		"""
@@ -75,6 +98,20 @@ class DjangoPage(object):
 
 		return template_path
 
+	def _prepare_render(self):
+		"""
+		Add the final render arguments and the page's media to the render
+		arguments, making the media known to the preloading middleware.
+		"""
+
+		#  Assemble CSS body classes and JavaScript and CSS media files
+		self.add_render_args(self.provide_final_render_args())
+		page_media = self._combine_form_media()
+		add_preload_media_collection(self.request, page_media)
+		self.add_render_args({
+			'page_media': page_media
+		})
+
 	def render(self, template_name, to_string=False):
 		"""
 		Return markup for the page, using the assembled rendering arguments and
@@ -84,15 +121,40 @@ class DjangoPage(object):
 		HttpResponse instance. If it is True, it is returned as a string.
 		"""
 
-		#  Assemble CSS body classes and JavaScript and CSS media files
-		self.add_render_args(self.provide_final_render_args())
-		self.add_render_args({
-			'page_media': self._combine_form_media()
-		})
+		self._prepare_render()
 
 		#  Return either an HTTP response object or a simple string, based on
 		#  the requested rendering type
 		render_function = render_to_string if to_string else render_to_response
-		return render_function(self.resolve_template_path(template_name),
-							   self._render_args,
-							   context_instance=RequestContext(self.request))
+		with timed('template', "Template rendering"):
+			return render_function(self.resolve_template_path(template_name),
+								   self._render_args,
+								   context_instance=RequestContext(self.request))
+
+	def render_fragments(self, templates):
+		"""
+		Return a dict of markup rendered from several templates, for views that
+		return multiple pieces of a page, such as AJAX views.
+
+		The `templates` argument is a dict whose keys will be the keys of the
+		returned dict and whose values are template paths, as would be passed to
+		`render`. Every template is rendered with the same context, so the
+		context processors are only run and the media only combined once.
+		"""
+
+		self._prepare_render()
+
+		fragments = {}
+		with timed('template', "Template rendering"):
+			context = RequestContext(self.request)
+			context.update(self._render_args)
+			for name, template_name in templates.iteritems():
+
+				#  Keep any changes made to the context by one template from
+				#  affecting the others
+				context.push()
+				try:
+					fragments[name] = get_template(self.resolve_template_path(template_name)).render(context)
+				finally:
+					context.pop()
+		return fragments
@@ -0,0 +1,498 @@
+from cilcdjango.core.util import get_app_setting
+
+from django.utils.datastructures import SortedDict
+
+from functools import wraps
+import logging
+import sys
+import thread
+import threading
+import time
+import traceback
+
+#  tracemalloc is only in the standard library from Python 3.4, and otherwise
+#  requires the pytracemalloc backport and a patched interpreter
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+#-------------------------------------------------------------------------------
+#  Sampling Profiler
+#-------------------------------------------------------------------------------
+
+def get_view_name(callback):
+	"""Return the dotted name under which profiles of the view `callback` are recorded."""
+	return "%s.%s" % (getattr(callback, '__module__', None) or "?", getattr(callback, '__name__', callback.__class__.__name__))
+
+class StackSampler(object):
+	"""
+	A statistical profiler that periodically samples the call stacks of the
+	threads that are handling requests.
+
+	A single daemon thread wakes every CILC_SAMPLING_PROFILER_INTERVAL seconds
+	and records the stack of each thread that has been registered as running a
+	view. The stacks are aggregated by view name into counts of identical
+	collapsed stacks, which is the input format used by flame graph tools.
+
+	The store is bounded so that it can be left running against production
+	traffic. At most CILC_SAMPLING_PROFILER_MAX_VIEWS views are tracked, each
+	with at most CILC_SAMPLING_PROFILER_MAX_STACKS distinct stacks, and samples
+	that do not fit are counted under a catch-all stack instead.
+	"""
+
+	logger = logging.getLogger("cilcdjango.profiling")
+
+	_OVERFLOW_STACK = "[other]"
+	_OVERFLOW_VIEW = "[other views]"
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._thread = None
+		self._active = {}
+		self._stacks = {}
+		self.samples = 0
+
+	def start(self):
+		"""Start the sampling thread, doing nothing if it is already running."""
+		if self._thread is not None:
+			return
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name="cilc-stack-sampler")
+				self._thread.setDaemon(True)
+				self._thread.start()
+
+	def register_thread(self, view_name):
+		"""Begin sampling the current thread as running the view `view_name`."""
+		self._active[thread.get_ident()] = view_name
+
+	def unregister_thread(self):
+		"""Stop sampling the current thread."""
+		self._active.pop(thread.get_ident(), None)
+
+	def _collapse_frame(self, frame, max_depth):
+		"""
+		Return the stack ending in `frame` as a semicolon-separated string of
+		function names, starting with the outermost frame.
+		"""
+		names = []
+		while frame is not None and len(names) < max_depth:
+			code = frame.f_code
+			names.append("%s:%s" % (frame.f_globals.get('__name__', code.co_filename), code.co_name))
+			frame = frame.f_back
+		names.reverse()
+		return ";".join(names).replace(" ", "_")
+
+	def _record(self, view_name, stack):
+		"""Count one sample of `stack` for the view `view_name`."""
+		stacks = self._stacks.get(view_name)
+		if stacks is None:
+			if len(self._stacks) >= get_app_setting('SAMPLING_PROFILER_MAX_VIEWS'):
+				view_name = self._OVERFLOW_VIEW
+			stacks = self._stacks.setdefault(view_name, {})
+		if stack not in stacks and len(stacks) >= get_app_setting('SAMPLING_PROFILER_MAX_STACKS'):
+			stack = self._OVERFLOW_STACK
+		stacks[stack] = stacks.get(stack, 0) + 1
+
+	def sample(self):
+		"""Record the current stack of every registered thread."""
+		frames = sys._current_frames()
+		max_depth = get_app_setting('SAMPLING_PROFILER_MAX_DEPTH')
+		with self._lock:
+			for thread_id, view_name in self._active.items():
+				frame = frames.get(thread_id)
+				if frame is not None:
+					self._record(view_name, self._collapse_frame(frame, max_depth))
+			self.samples += 1
+
+	def _run(self):
+		"""Sample the registered threads until the process exits."""
+		while True:
+			time.sleep(get_app_setting('SAMPLING_PROFILER_INTERVAL'))
+			try:
+				self.sample()
+			except Exception:
+				self.logger.exception("the sampling profiler failed")
+
+	def get_views(self):
+		"""Return a sorted list of the names of the views that have samples."""
+		with self._lock:
+			return sorted(self._stacks.keys())
+
+	def get_collapsed_stacks(self, view_name=None):
+		"""
+		Return the recorded samples in the collapsed stack format, with one line
+		per distinct stack giving the stack and its sample count. Each stack is
+		prefixed with the name of its view, unless only the samples for the view
+		`view_name` are requested.
+		"""
+		lines = []
+		with self._lock:
+			for name, stacks in sorted(self._stacks.items()):
+				if view_name is None:
+					prefix = "%s;" % name.replace(" ", "_")
+				elif name == view_name:
+					prefix = ""
+				else:
+					continue
+				for stack, count in sorted(stacks.items()):
+					lines.append("%s%s %d" % (prefix, stack, count))
+		return "\n".join(lines)
+
+	def clear(self):
+		"""Discard all recorded samples."""
+		with self._lock:
+			self._stacks = {}
+			self.samples = 0
+
+stack_sampler = StackSampler()
+
+#-------------------------------------------------------------------------------
+#  Request Timing
+#-------------------------------------------------------------------------------
+
+_timing_state = threading.local()
+
+class RequestTimer(object):
+	"""
+	The named timings collected while handling a single request.
+
+	Each timing accumulates the total duration and the number of times that
+	it was recorded, so repeated operations such as LDAP queries or the
+	rendering of several media items are reported as a single metric.
+	"""
+
+	def __init__(self):
+		self.timings = SortedDict()
+
+	def add(self, name, duration, description=None):
+		"""Add `duration` seconds to the timing called `name`."""
+		timing = self.timings.get(name)
+		if timing is None:
+			timing = self.timings[name] = {'duration': 0, 'count': 0, 'description': description}
+		timing['duration'] += duration
+		timing['count'] += 1
+
+def start_request_timing():
+	"""Begin collecting timings for the request handled by the current thread."""
+	timer = RequestTimer()
+	_timing_state.timer = timer
+	return timer
+
+def stop_request_timing():
+	"""Stop collecting timings for the current thread, returning its timer."""
+	timer = getattr(_timing_state, 'timer', None)
+	_timing_state.timer = None
+	return timer
+
+def add_timing(name, duration, description=None):
+	"""
+	Add `duration` seconds to the timing called `name` for the request being
+	handled by the current thread, doing nothing if no timings are collected.
+	"""
+	timer = getattr(_timing_state, 'timer', None)
+	if timer is not None:
+		timer.add(name, duration, description)
+
+class timed(object):
+	"""
+	Time a block of code or each call to a function under the name `name`,
+	which is reported by the ServerTimingMiddleware.
+
+	This can be used as a context manager or as a decorator:
+
+	>>> with timed('search', "Search index"):
+	...     results = index.search(terms)
+
+	>>> @timed('search', "Search index")
+	... def search(terms):
+	...     pass
+
+	"""
+
+	def __init__(self, name, description=None):
+		self.name = name
+		self.description = description
+		self._starts = threading.local()
+
+	def __enter__(self):
+		starts = getattr(self._starts, 'stack', None)
+		if starts is None:
+			starts = self._starts.stack = []
+		starts.append(time.time())
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		add_timing(self.name, time.time() - self._starts.stack.pop(), self.description)
+		return False
+
+	def __call__(self, function):
+		@wraps(function)
+		def timed_function(*args, **kwargs):
+			with self:
+				return function(*args, **kwargs)
+		return timed_function
+
+#-------------------------------------------------------------------------------
+#  Memory Profiling
+#-------------------------------------------------------------------------------
+
+_tracing_lock = threading.Lock()
+_tracing_users = [0]
+
+def acquire_memory_tracing():
+	"""
+	Start tracing memory allocations if they are not already being traced,
+	returning False if tracemalloc is not available. Each successful call must
+	be matched by a call to `release_memory_tracing`.
+	"""
+	if tracemalloc is None:
+		return False
+	with _tracing_lock:
+		if not tracemalloc.is_tracing():
+			tracemalloc.start(get_app_setting('MEMORY_PROFILER_FRAMES'))
+		_tracing_users[0] += 1
+	return True
+
+def release_memory_tracing():
+	"""Stop tracing memory allocations once nothing is using the trace."""
+	with _tracing_lock:
+		_tracing_users[0] -= 1
+		if _tracing_users[0] <= 0:
+			_tracing_users[0] = 0
+			tracemalloc.stop()
+
+def take_memory_snapshot():
+	"""Return a snapshot of the traced allocations, excluding tracemalloc's own."""
+	return tracemalloc.take_snapshot().filter_traces([
+		tracemalloc.Filter(False, tracemalloc.__file__),
+		tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+		tracemalloc.Filter(False, "<unknown>")
+	])
+
+def format_memory_statistics(statistics, limit):
+	"""
+	Return a plain-text table of up to `limit` tracemalloc statistics, which
+	can come from a snapshot or from the difference between two snapshots.
+	"""
+
+	res = "      size  blocks  site\n"
+	for stat in statistics[:limit]:
+		frame = stat.traceback[0]
+		size_diff = getattr(stat, 'size_diff', None)
+		if size_diff is None:
+			res += "%8.1fK %7d  %s:%d\n" % (stat.size / 1024.0, stat.count, frame.filename, frame.lineno)
+		else:
+			res += "%+8.1fK %+7d  %s:%d\n" % (size_diff / 1024.0, stat.count_diff, frame.filename, frame.lineno)
+	return res
+
+class MemorySnapshots(object):
+	"""
+	Periodic snapshots of the traced memory allocations, kept per view.
+
+	After every CILC_MEMORY_PROFILER_INTERVAL requests to a view, a snapshot
+	is taken and compared with the previous one for the same view. The largest
+	differences show the allocation sites that grew while the view was being
+	used, which is where a slow leak will show up, although a snapshot covers
+	the whole process and so also includes the growth caused by other views.
+
+	Each tracked view holds one full snapshot as its baseline, so at most
+	CILC_MEMORY_PROFILER_MAX_VIEWS views are tracked, and requests to any
+	other view are ignored.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._started = False
+		self._counts = {}
+		self._snapshots = {}
+		self._reports = {}
+
+	def start(self):
+		"""Begin tracing allocations, returning False if this is not possible."""
+		if not self._started:
+			self._started = acquire_memory_tracing()
+		return self._started
+
+	def record(self, view_name):
+		"""Count a request to the view `view_name`, taking a snapshot if one is due."""
+		if not self._started:
+			return
+		with self._lock:
+			if view_name not in self._counts and len(self._counts) >= get_app_setting('MEMORY_PROFILER_MAX_VIEWS'):
+				return
+			count = self._counts.get(view_name, 0) + 1
+			self._counts[view_name] = count
+			if count % get_app_setting('MEMORY_PROFILER_INTERVAL'):
+				return
+			snapshot = take_memory_snapshot()
+			previous = self._snapshots.get(view_name)
+			self._snapshots[view_name] = snapshot
+			if previous is not None:
+				self._reports[view_name] = {
+					'requests': count,
+					'time': time.time(),
+					'diff': format_memory_statistics(snapshot.compare_to(previous, 'lineno'), get_app_setting('MEMORY_PROFILER_LIMIT'))
+				}
+
+	def get_reports(self):
+		"""Return a sorted list of (view name, report) tuples for each view's last snapshot diff."""
+		with self._lock:
+			return sorted(self._reports.items())
+
+	def clear(self):
+		"""Discard all snapshots and reports."""
+		with self._lock:
+			self._counts = {}
+			self._snapshots = {}
+			self._reports = {}
+
+memory_snapshots = MemorySnapshots()
+
+#-------------------------------------------------------------------------------
+#  Slow Request Watchdog
+#-------------------------------------------------------------------------------
+
+class RequestWatchdog(object):
+	"""
+	Reports requests that run for longer than CILC_WATCHDOG_THRESHOLD seconds.
+
+	Registering a request only stores a small dict of the request and its
+	view under the thread's ID, which are only described if the request is
+	reported, so fast requests pay almost nothing. A daemon thread checks the registered
+	requests every CILC_WATCHDOG_INTERVAL seconds and captures the stack of
+	each one that has passed the threshold, up to CILC_WATCHDOG_MAX_CAPTURES
+	times. A report with the view, its arguments and the captured stacks is
+	written when the request finishes or when its last stack is captured, so
+	a request that never finishes is still reported.
+
+	Reports are written to the "cilcdjango.watchdog" logger, or appended to
+	the file named by the CILC_WATCHDOG_FILE setting if it is given.
+	"""
+
+	logger = logging.getLogger("cilcdjango.watchdog")
+
+	#  The longest that the repr of a view's arguments can be in a report
+	_MAX_ARGS_LENGTH = 500
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._file_lock = threading.Lock()
+		self._thread = None
+		self._active = {}
+
+	def start(self):
+		"""Start the watchdog thread, doing nothing if it is already running."""
+		if self._thread is not None:
+			return
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name="cilc-request-watchdog")
+				self._thread.setDaemon(True)
+				self._thread.start()
+
+	def register_request(self, request, view_name, view_args, view_kwargs):
+		"""Begin watching `request`, which calls the view `view_name`, in the current thread."""
+		self._active[thread.get_ident()] = {
+			'start': time.time(),
+			'request': request,
+			'view': (view_name, view_args, view_kwargs),
+			'stacks': [],
+			'reported': False
+		}
+
+	def unregister_request(self):
+		"""Stop watching the current thread's request, reporting it if it was slow."""
+		watched = self._active.pop(thread.get_ident(), None)
+		if watched is not None and watched['stacks']:
+			with self._lock:
+				report = self._make_report(watched, finished=True)
+			self._write(report)
+
+	def _format_stack(self, frame):
+		"""Return a compact, one line per frame representation of the stack ending in `frame`."""
+		entries = traceback.extract_stack(frame)[-get_app_setting('WATCHDOG_STACK_DEPTH'):]
+		return "\n".join(["    %s:%d %s" % (filename, line, function) for filename, line, function, text in entries])
+
+	def _make_report(self, watched, finished):
+		"""
+		Return the report for the `watched` request, which may still be running,
+		or None if there is nothing new to report. This must be called with the
+		lock held, and the report written once it is released.
+		"""
+		duration = time.time() - watched['start']
+		description = self.describe_request(watched['request'], *watched['view'])
+		if watched['reported']:
+			if finished:
+				return "slow request finished after %.1fs: %s" % (duration, description)
+			return None
+		watched['reported'] = True
+
+		lines = ["slow request %s after %.1fs: %s" % ("finished" if finished else "still running", duration, description)]
+		for elapsed, stack in watched['stacks']:
+			lines.append("  stack at %.1fs:" % elapsed)
+			lines.append(stack)
+		return "\n".join(lines)
+
+	def _write(self, report):
+		"""Write `report` to the configured sink, doing nothing if it is None."""
+		if report is None:
+			return
+		path = get_app_setting('WATCHDOG_FILE')
+		if path:
+			with self._file_lock:
+				log_file = open(path, "a")
+				try:
+					log_file.write("[%s] %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), report))
+				finally:
+					log_file.close()
+		else:
+			self.logger.warning(report)
+
+	def check(self):
+		"""Capture the stacks of any registered requests that are running slowly."""
+
+		now = time.time()
+		threshold = get_app_setting('WATCHDOG_THRESHOLD')
+		interval = get_app_setting('WATCHDOG_INTERVAL')
+		max_captures = get_app_setting('WATCHDOG_MAX_CAPTURES')
+		frames = None
+		reports = []
+
+		with self._lock:
+			for thread_id, watched in self._active.items():
+				elapsed = now - watched['start']
+				captures = len(watched['stacks'])
+				if elapsed < threshold or captures >= max_captures:
+					continue
+				if captures and elapsed - watched['stacks'][-1][0] < interval:
+					continue
+				if frames is None:
+					frames = sys._current_frames()
+				frame = frames.get(thread_id)
+				if frame is not None:
+					watched['stacks'].append((elapsed, self._format_stack(frame)))
+					if len(watched['stacks']) >= max_captures:
+						reports.append(self._make_report(watched, finished=False))
+
+		for report in reports:
+			self._write(report)
+
+	def _run(self):
+		"""Check the registered requests until the process exits."""
+		while True:
+			time.sleep(get_app_setting('WATCHDOG_INTERVAL'))
+			try:
+				self.check()
+			except Exception:
+				self.logger.exception("the request watchdog failed")
+
+	def describe_request(self, request, view_name, view_args, view_kwargs):
+		"""Return a one-line description of a request for a report."""
+		args = repr((view_args, view_kwargs))
+		if len(args) > self._MAX_ARGS_LENGTH:
+			args = args[:self._MAX_ARGS_LENGTH] + "..."
+		return "%s %s -> %s%s" % (request.method, request.get_full_path(), view_name, args)
+
+request_watchdog = RequestWatchdog()
@@ -1,5 +1,6 @@
 
-from cilcdjango.core.media import make_shared_media_url, make_secure_media_url
+from cilcdjango.core.cache import FragmentCache
+from cilcdjango.core.media import add_preload_media, make_shared_media_url, make_secure_media_url
 from cilcdjango.core.forms import DjangoForm, DjangoModelForm
 import cilcdjango.core.text
 from cilcdjango.core.util import get_app_setting, rfc3339_to_datetime
@@ -7,10 +8,12 @@ from cilcdjango.core.util import get_app_setting, rfc3339_to_datetime
 from django import template
 from django.conf import settings
 from django.template.defaultfilters import date, stringfilter
+from django.utils import translation
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _, ugettext
 
 import datetime
+from HTMLParser import HTMLParser, HTMLParseError
 import lxml.html
 import os
 import re
@@ -110,7 +113,7 @@ def form_field(parser, token):
 			raise template.TemplateSyntaxError(ugettext("the form_field tag requires a form instance and then a field name"))
 		else:
 			classes = u""
-	classes = re.split(r'\s+', re.sub(r'["\']', '', classes))
+	classes = [klass for klass in re.split(r'\s+', re.sub(r'["\']', '', classes)) if klass]
 	return FormFieldNode(form_name, field_name, classes)
 
 class FormFieldNode(template.Node):
@@ -135,10 +138,7 @@ class FormFieldNode(template.Node):
 			raise template.TemplateSyntaxError(
 				ugettext("the form passed to the form_field tag must be a subclass of DjangoForm or DjangoModelForm"))
 
-		form.add_field_classes(self._field_name, self._classes)
-		markup = form.field.render_field(self._field_name)
-		form.remove_field_classes(self._field_name, self._classes)
-		return markup
+		return form.field.render_field(self._field_name, extra_classes=self._classes)
 
 @register.tag
 def strip_ws(parser, token):
@@ -157,6 +157,61 @@ class StripWSNode(template.Node):
 		output = self.nodelist.render(context)
 		return output.strip()
 
+class _ContentFound(Exception):
+	"""Raised by the emptiness parser as soon as it finds meaningful content."""
+	pass
+
+class _EmptyMarkupParser(HTMLParser):
+	"""
+	A streaming parser that determines whether a fragment of markup contains
+	any text or any void element that is not in the `ignore_tags` set.
+
+	Parsing stops as soon as content is found, so a non-empty fragment is
+	usually rejected after reading only its first few tokens.
+	"""
+
+	#  Entities that only produce whitespace and thus do not count as content
+	_WHITESPACE_ENTITIES = set(['nbsp', 'ensp', 'emsp', 'thinsp'])
+
+	def __init__(self, void_tags):
+		HTMLParser.__init__(self)
+		self._void_tags = void_tags
+
+	def handle_starttag(self, tag, attrs):
+		if tag in self._void_tags:
+			raise _ContentFound
+
+	def handle_startendtag(self, tag, attrs):
+		self.handle_starttag(tag, attrs)
+
+	def handle_data(self, data):
+		if data.strip():
+			raise _ContentFound
+
+	def handle_entityref(self, name):
+		if name not in self._WHITESPACE_ENTITIES:
+			raise _ContentFound
+
+	def handle_charref(self, name):
+		try:
+			char = unichr(int(name[1:], 16) if name[0] in ('x', 'X') else int(name))
+		except (ValueError, OverflowError):
+			raise _ContentFound
+		if char.strip():
+			raise _ContentFound
+
+	def is_empty(self, markup):
+		"""
+		Return True if `markup` has neither text nor a counted void element,
+		raising an HTMLParseError if the markup cannot be tokenized.
+		"""
+		try:
+			self.feed(markup)
+			self.close()
+		except _ContentFound:
+			return False
+		return True
+
 @register.tag
 def remove_empty_attr(parser, token):
 	"""Remove an attribute from a tag if its value is blank."""
@@ -167,15 +222,14 @@ def remove_empty_attr(parser, token):
 class EmptyAttributeNode(template.Node):
 	"""Renderer for the `remote_empty_attr` tag."""
 
-	_is_empty_tag = re.compile(r'\w+\=["\']{2}')
+	_is_empty_tag = re.compile(r'\w+ *\= *(?:"\s*"|\'\s*\')')
 
 	def __init__(self, nodelist):
 		self.nodelist = nodelist
 
 	def render(self, context):
 		output = self.nodelist.render(context)
-		tag_base = output.strip().replace(" ", "")
-		return "" if self._is_empty_tag.search(tag_base) else output
+		return "" if self._is_empty_tag.search(output) else output
 
 @register.tag
 def remove_empty_tag(parser, token):
@@ -201,15 +255,72 @@ class EmptyTagNode(template.Node):
 		self.nodelist = nodelist
 		self.empty_tags = lxml.html.defs.empty_tags - self._ignore_empty_tags
 
+	def _is_empty_lxml(self, output):
+		"""
+		Determine emptiness by building a full element tree of the markup,
+		which is only used for markup that the streaming parser rejects.
+		"""
+		root = lxml.html.fragment_fromstring(output)
+		return all([
+			not tag.text_content().strip() and tag.tag not in self.empty_tags
+			for tag in root.iter()])
+
 	def render(self, context):
 		"""Return the tag's markup if it is not empty, or nothing if it is."""
 		output = self.nodelist.render(context)
-		root = lxml.html.fragment_fromstring(output)
-		if all([
-			not tag.text_content().strip() and tag.tag not in self.empty_tags
-			for tag in root.iter()]):
-			return u""
-		return output
+		try:
+			is_empty = _EmptyMarkupParser(self.empty_tags).is_empty(output)
+		except HTMLParseError:
+			is_empty = self._is_empty_lxml(output)
+		return u"" if is_empty else output
+
+#-------------------------------------------------------------------------------
+#  Caching Tags
+#-------------------------------------------------------------------------------
+
+@register.tag
+def cached_fragment(parser, token):
+	"""
+	When called as {% cached_fragment name obj1 obj2 %}, cache the markup up to
+	the matching {% endcached_fragment %} tag, where `name` identifies the
+	fragment and the optional arguments after it are the model instances,
+	QuerySets or model classes whose data the markup displays.
+
+	The cached markup is discarded as soon as any of that model data is saved
+	or deleted. Any other values passed as arguments become part of the key.
+	"""
+	bits = token.split_contents()
+	if len(bits) < 2:
+		raise template.TemplateSyntaxError(ugettext("the cached_fragment tag requires a fragment name"))
+	nodelist = parser.parse(('endcached_fragment',))
+	parser.delete_first_token()
+	return CachedFragmentNode(nodelist, parser.compile_filter(bits[1]), [parser.compile_filter(bit) for bit in bits[2:]])
+
+class CachedFragmentNode(template.Node):
+	"""Renderer for the `cached_fragment` tag."""
+
+	def __init__(self, nodelist, name, vary_on):
+		self.nodelist = nodelist
+		self._name = name
+		self._vary_on = vary_on
+
+	def render(self, context):
+		"""
+		Return the cached markup for the fragment, rendering it if it is not
+		cached or if the data that it depends on has changed.
+		"""
+
+		#  The markup also varies by language and, because media URLs are
+		#  made secure for secure requests, by the security of the request
+		request = context.get('request', None)
+		key_parts = [translation.get_language(), request is not None and request.is_secure()]
+
+		fragment = FragmentCache(
+			self._name.resolve(context),
+			key_parts,
+			[var.resolve(context) for var in self._vary_on]
+		)
+		return fragment.get_or_render(lambda: self.nodelist.render(context))
 
 #-------------------------------------------------------------------------------
 #  Media Tags
@@ -334,7 +445,14 @@ class AddMediaCollectionNode(template.Node):
 			return ""
 
 class AddMediaNode(template.Node):
-	"""Base class for any media addition nodes."""
+	"""
+	Base class for any media addition nodes.
+
+	Child classes must define a `preload_as` attribute, which is the type of
+	the media as used in a preload Link header, such as "script" or "style".
+	"""
+
+	preload_as = None
 
 	def __init__(self, file_path, shared):
 		self.shared = shared
@@ -363,10 +481,13 @@ class AddMediaNode(template.Node):
 	def render(self, context):
 		"""
 		Return markup to include the the media only if it has yet to be included
-		by a previous tag.
+		by a previous tag, recording the media so that it can be preloaded.
 		"""
 
-		self._normalize_file(context.get('request', None))
+		request = context.get('request', None)
+		self._normalize_file(request)
+		if self.should_preload():
+			add_preload_media(request, self.file_path, self.preload_as)
 		markup = mark_safe(self.add_media())
 
 		#  Create a render context to keep track of loaded media for Django 1.2
@@ -396,9 +517,15 @@ class AddMediaNode(template.Node):
 		"""
 		raise NotImplementedError
 
+	def should_preload(self):
+		"""Return True if the browser should be told to preload the media."""
+		return True
+
 class AddCSSNode(AddMediaNode):
 	"""A node that includes a CSS file via a <link> to an external stylesheet."""
 
+	preload_as = "style"
+
 	IS_IE_SHEET = re.compile(r'ie\.(?P<condition>\w{2,3})?\.?(?P<version>\d+(\.\d+)?)?\.?css$')
 
 	def __init__(self, file_path, media_types, shared):
@@ -406,6 +533,13 @@ class AddCSSNode(AddMediaNode):
 		super(AddCSSNode, self).__init__(file_path, shared)
 		self.media_types = self._un_quote(media_types)
 
+	def should_preload(self):
+		"""
+		Return True if the stylesheet is not meant only for IE, as a preload
+		would make every browser fetch a sheet hidden by conditional comments.
+		"""
+		return not self.IS_IE_SHEET.search(self.file_path)
+
 	def _process_ie_stylesheets(self, base_markup):
 		"""
 		Wrap conditional CSS meant only for IE in conditional comments.
@@ -448,5 +582,7 @@ class AddCSSNode(AddMediaNode):
 class AddJavaScriptNode(AddMediaNode):
 	"""A node that includes an external JavaScript file via a <script> tag."""
 
+	preload_as = "script"
+
 	def add_media(self):
 		return '<script type="text/javascript" src="%s"></script>' % self.file_path
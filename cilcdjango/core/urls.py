@@ -0,0 +1,15 @@
+
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('cilcdjango.core.views',
+
+	#  AJAX
+	url(r'^ajax/batch/$', 'ajax_batch', name="cilc-ajax-batch"),
+
+	#  JavaScript globals
+	url(r'^js/globals/(?P<object_name>\w+)/(?P<version>\w+)\.js$', 'javascript_globals', name="cilc-javascript-globals"),
+
+	#  Profiling
+	url(r'^profiling/samples/$', 'sampling_profile', name="cilc-sampling-profile"),
+	url(r'^profiling/memory/$', 'memory_profile', name="cilc-memory-profile")
+)
@@ -1,4 +1,6 @@
 
+from cilcdjango.core.profiling import timed
+
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
@@ -55,6 +57,7 @@ class LDAPConnection():
 		'professor':  'o'
 	}
 
+	@timed('ldap', "LDAP")
 	def __init__(self, user_id=None, user_password=None):
 		"""
 		Initialize a connection to the LDAP server, using the provided user
@@ -91,6 +94,7 @@ class LDAPConnection():
 		"""
 		return self._make_ldap_query({'OberlinTNumber': t_number})
 
+	@timed('ldap', "LDAP")
 	def _make_ldap_query(self, query_args, unique=True):
 		"""
 		Execute an LDAP query for a user who matches the filter parameters
@@ -3,24 +3,59 @@ from django.conf import settings
 from django.template.defaultfilters import date as django_date
 from django.utils.translation import ugettext_lazy as _
 
-from feedparser import _parse_date as parse_date
 import pytz
 
 import datetime
 import os
+import re
 import sys
-import time
 
 _setting_defaults = {
-	'APPLICATION_NAME':      "",
-	'RTE_CONFIG_FILE':       "",
-	'SHARED_MEDIA_URL':      "",
-	'SUPPORT_EMAIL_ADDRESS': "",
-	'SUPPORT_EMAIL_NAME':    ""
+	'AJAX_BATCH_MAX_CALLS':                20,
+	'AJAX_RETRY_AFTER':                    2,
+	'APPLICATION_NAME':                    "",
+	'FRAGMENT_CACHE_TIMEOUT':              60 * 60,
+	'MEDIA_LIBRARY_FILTERS_CACHE_TIMEOUT': 60 * 10,
+	'MEDIA_LIBRARY_MARKUP_CACHE_TIMEOUT':  60 * 60,
+	'MEDIA_LIBRARY_MAX_FILTERS':           4,
+	'MEDIA_LIBRARY_MAX_SAVES':             2,
+	'MEDIA_LIBRARY_QUEUE_TIMEOUT':         5,
+	'MEDIA_LIBRARY_SHARED_LIMITS':         False,
+	'MEMORY_PROFILER_FRAMES':              1,
+	'MEMORY_PROFILER_INTERVAL':            100,
+	'MEMORY_PROFILER_LIMIT':               40,
+	'MEMORY_PROFILER_MAX_VIEWS':           10,
+	'MEMORY_SNAPSHOTS':                    False,
+	'PRELOAD_EARLY_HINTS':                 False,
+	'RTE_CONFIG_FILE':                     "",
+	'SAMPLING_PROFILER_INTERVAL':          0.01,
+	'SAMPLING_PROFILER_MAX_DEPTH':         100,
+	'SAMPLING_PROFILER_MAX_STACKS':        500,
+	'SAMPLING_PROFILER_MAX_VIEWS':         100,
+	'SERVER_TIMING_LOG':                   False,
+	'SERVER_TIMING_PUBLIC':                False,
+	'SERVER_TIMING_QUERIES':               False,
+	'SHARED_MEDIA_URL':                    "",
+	'SUPPORT_EMAIL_ADDRESS':               "",
+	'SUPPORT_EMAIL_NAME':                  "",
+	'WATCHDOG_FILE':                       None,
+	'WATCHDOG_INTERVAL':                   2,
+	'WATCHDOG_MAX_CAPTURES':               5,
+	'WATCHDOG_STACK_DEPTH':                30,
+	'WATCHDOG_THRESHOLD':                  10
 }
 
 TELLTALE_DJANGO_FILES = set(['manage.py', 'settings.py'])
 
+_RFC3339_DATETIME = re.compile(
+	r'^(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})[Tt ]'
+	r'(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})(?:\.(?P<fraction>\d+))?'
+	r'(?:(?P<utc>[Zz])|(?P<offset_sign>[+-])(?P<offset_hour>\d{2}):(?P<offset_minute>\d{2}))$'
+)
+
+#  Timezones created for the project's TIME_ZONE setting, keyed by name
+_time_zones = {}
+
 #-------------------------------------------------------------------------------
 #  Configuration
 #-------------------------------------------------------------------------------
@@ -70,14 +105,64 @@ def configure_django_paths(script_path):
 #  Date / Time
 #-------------------------------------------------------------------------------
 
+def _get_time_zone():
+	"""
+	Return the pytz timezone for the project's TIME_ZONE setting, which is only
+	looked up the first time that a given zone name is requested.
+	"""
+	name = settings.TIME_ZONE
+	try:
+		return _time_zones[name]
+	except KeyError:
+		time_zone = _time_zones[name] = pytz.timezone(name)
+		return time_zone
+
+def parse_rfc3339(dt):
+	"""
+	Return the RFC 3339 datetime string in `dt` as a timezone-aware datetime
+	object whose timezone is the fixed offset given in the string.
+
+	A ValueError is raised if `dt` is not a valid RFC 3339 datetime.
+	"""
+
+	match = _RFC3339_DATETIME.match(dt.strip())
+	if not match:
+		raise ValueError("%r is not a valid RFC 3339 datetime" % dt)
+	parts = match.groupdict()
+
+	#  Determine the timezone from the UTC designator or the numeric offset
+	if parts['utc']:
+		tz_info = pytz.utc
+	else:
+		offset = int(parts['offset_hour']) * 60 + int(parts['offset_minute'])
+		if parts['offset_sign'] == "-":
+			offset = -offset
+		tz_info = pytz.FixedOffset(offset) if offset else pytz.utc
+
+	#  Use a precision of microseconds for any fractional seconds, and treat
+	#  a leap second as the last second of its minute
+	fraction = parts['fraction'] or ""
+	return datetime.datetime(
+		int(parts['year']), int(parts['month']), int(parts['day']),
+		int(parts['hour']), int(parts['minute']), min(int(parts['second']), 59),
+		int(fraction[:6].ljust(6, "0")),
+		tz_info
+	)
+
 def rfc3339_to_datetime(dt):
 	"""
 	Return the RFC 3339 datetime string in `dt` as timezone-aware Django
 	datetime object.
 	"""
-	utc_dt = pytz.utc.localize(datetime.datetime.fromtimestamp(time.mktime(parse_date(dt))))
-	time_zone = pytz.timezone(settings.TIME_ZONE)
-	return utc_dt.astimezone(time_zone)
+	return parse_rfc3339(dt).astimezone(_get_time_zone())
+
+def rfc3339_list_to_datetimes(dt_list):
+	"""
+	Return a list of timezone-aware Django datetime objects for each RFC 3339
+	datetime string in the iterable `dt_list`.
+	"""
+	time_zone = _get_time_zone()
+	return [parse_rfc3339(dt).astimezone(time_zone) for dt in dt_list]
 
 def format_date(date_obj):
 	"""
@@ -0,0 +1,169 @@
+from cilcdjango.core.ajax import ajax_views
+from cilcdjango.core.context_processors import get_context_class, get_javascript_globals
+from cilcdjango.core.decorators import ajax_view
+from cilcdjango.core.exceptions import AjaxError
+from cilcdjango.core.profiling import memory_snapshots, stack_sampler
+
+from cilcdjango.core.util import get_app_setting
+
+from django.contrib.auth.decorators import user_passes_test
+from django.http import Http404, HttpResponse, QueryDict
+from django.utils.cache import patch_cache_control
+from django.utils.datastructures import MultiValueDict
+from django.utils.html import escape
+from django.utils.translation import ugettext as _
+
+import copy
+import logging
+import simplejson as json
+
+#  The number of seconds that a versioned JavaScript globals file can be cached
+_JS_GLOBALS_MAX_AGE = 60 * 60 * 24 * 365
+
+#  The URL name of the AJAX batch view, which cannot call itself
+_AJAX_BATCH_URL_NAME = "cilc-ajax-batch"
+
+logger = logging.getLogger("cilcdjango.ajax")
+
+def javascript_globals(request, object_name, version):
+	"""
+	Serve the JavaScript globals script whose content hash is `version`, which
+	defines the custom settings object under the name `object_name`.
+
+	If the requested version was not rendered by this process, the script is
+	rendered again by the context class that defines the object, and a 404 is
+	raised if no context class does. The response can only be cached
+	indefinitely if the script matches the requested version.
+	"""
+
+	script = get_javascript_globals(object_name, version)
+	if script is None:
+		context_class = get_context_class(object_name)
+		if context_class is None:
+			raise Http404
+		static = context_class(request)._get_static_output()
+		script = static['globals_script']
+		is_current = static['globals_version'] == version
+	else:
+		is_current = True
+
+	response = HttpResponse(script, mimetype='text/javascript')
+	if is_current:
+		patch_cache_control(response, public=True, max_age=_JS_GLOBALS_MAX_AGE)
+	else:
+		patch_cache_control(response, no_cache=True, max_age=0)
+	return response
+
+@user_passes_test(lambda user: user.is_superuser)
+def sampling_profile(request):
+	"""
+	Serve the samples recorded by the SamplingProfilerMiddleware as collapsed
+	stacks, which can be passed directly to flamegraph.pl or speedscope.
+
+	The samples for a single view can be requested by passing its dotted name
+	as the "view" query string value, while a "views" value lists the names of
+	the sampled views instead. Making the request with POST discards the
+	samples after they have been served.
+	"""
+
+	if 'views' in request.GET:
+		output = "\n".join(stack_sampler.get_views())
+	else:
+		output = stack_sampler.get_collapsed_stacks(request.GET.get('view') or None)
+	if request.method == "POST":
+		stack_sampler.clear()
+
+	response = HttpResponse(output, mimetype='text/plain')
+	patch_cache_control(response, no_cache=True, max_age=0)
+	return response
+
+@user_passes_test(lambda user: user.is_superuser)
+def memory_profile(request):
+	"""
+	Show the latest comparison of memory snapshots for each view recorded by
+	the MemoryProfileMiddleware. Making the request with POST discards the
+	snapshots after they have been shown.
+	"""
+
+	sections = []
+	for view_name, report in memory_snapshots.get_reports():
+		sections.append(" ---- %s (%d requests) ----\n\n%s" % (view_name, report['requests'], report['diff']))
+	if request.method == "POST":
+		memory_snapshots.clear()
+
+	response = HttpResponse("<pre>" + escape("\n".join(sections) or "No snapshots have been compared") + "</pre>")
+	patch_cache_control(response, no_cache=True, max_age=0)
+	return response
+
+def _make_batch_call_request(request, call_kwargs):
+	"""
+	Return a copy of `request` for a single call in an AJAX batch, whose body is
+	a JSON object containing `call_kwargs` and which has no query string or
+	uploaded files. The request's cached body and files are replaced directly,
+	as Django provides no way to set them.
+	"""
+	call_request = copy.copy(request)
+	call_request.META = request.META.copy()
+	call_request.META['CONTENT_TYPE'] = "application/json"
+	call_request._raw_post_data = json.dumps(call_kwargs)
+	call_request.GET = QueryDict("")
+	call_request.POST = QueryDict("", mutable=True)
+	call_request._files = MultiValueDict()
+	return call_request
+
+def _call_batched_view(request, call):
+	"""
+	Return the result of a single call in an AJAX batch, as a dict that is the
+	view's JSON response or that describes why the call failed.
+	"""
+
+	if not isinstance(call, dict):
+		return {'success': False, 'error': _("Each call must be an object")}
+	view_name = call.get('view_name')
+	call_kwargs = call.get('kwargs') or {}
+	view = ajax_views.get_view(view_name) if view_name != _AJAX_BATCH_URL_NAME else None
+	if view is None:
+		return {'success': False, 'error': _("No AJAX view is named %(view)s") % {'view': view_name}}
+	if not isinstance(call_kwargs, dict):
+		return {'success': False, 'error': _("The arguments for %(view)s must be an object") % {'view': view_name}}
+
+	#  Isolate the call, so that an exception raised by the view is reported
+	#  as its result rather than failing the entire batch
+	try:
+		response = view(_make_batch_call_request(request, call_kwargs))
+	except Exception:
+		logger.exception("the batched call to %s failed" % view_name)
+		return {'success': False, 'error': _("The call to %(view)s failed") % {'view': view_name}}
+
+	try:
+		result = json.loads(response.content)
+	except ValueError:
+		result = {'success': False, 'error': _("%(view)s did not return JSON") % {'view': view_name}}
+	if response.status_code != 200 and isinstance(result, dict):
+		result['success'] = False
+		result['status'] = response.status_code
+	return result
+
+@ajax_view
+def ajax_batch(request, calls=None):
+	"""
+	Call several AJAX views in a single request, returning their JSON responses
+	as a list in the same order as the calls.
+
+	This expects a JSON body whose "calls" member is a list of objects, each
+	with a "view_name" member naming the URL pattern of an AJAX view and an
+	optional "kwargs" object of the values that the view would normally be
+	sent. Each call is made with its own copy of the request, and a call that
+	fails only causes its own result to be unsuccessful, with its exception
+	logged to the "cilcdjango.ajax" logger.
+	"""
+
+	if calls is None:
+		calls = []
+	elif not isinstance(calls, list):
+		raise AjaxError(_("the calls must be a list"))
+	if len(calls) > get_app_setting('AJAX_BATCH_MAX_CALLS'):
+		raise AjaxError(_("a batch can contain at most %(count)d calls") % {'count': get_app_setting('AJAX_BATCH_MAX_CALLS')})
+	return {
+		'results': [_call_batched_view(request, call) for call in calls]
+	}
@@ -1,6 +1,7 @@
 
 from cilcdjango.medialibrary import renderers
 import cilcdjango.medialibrary.settings as _settings
+from cilcdjango.core.profiling import timed
 from cilcdjango.core.text import smart_title
 
 from django.db import models
@@ -264,6 +265,7 @@ class MediaItem(models.Model):
 		else:
 			return None
 
+	@timed('media', "Media rendering")
 	def render(self):
 		"""
 		Return the markup required to render the file in a page, using the
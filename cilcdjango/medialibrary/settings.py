@@ -9,4 +9,15 @@ ADD_GROUP_FORM_AUTO_ID = "id_group_%s"
 
 MEDIA_PLAYER_URL = "flash/jwplayer/player.swf"
 
+#  The number of seconds for which the responses of AJAX views are cached
+FILTERS_CACHE_TIMEOUT = get_app_setting('MEDIA_LIBRARY_FILTERS_CACHE_TIMEOUT')
+MEDIA_MARKUP_CACHE_TIMEOUT = get_app_setting('MEDIA_LIBRARY_MARKUP_CACHE_TIMEOUT')
+
+#  The number of concurrent executions allowed for expensive AJAX views, and
+#  the number of seconds that a request will wait for its turn
+MAX_CONCURRENT_FILTERS = get_app_setting('MEDIA_LIBRARY_MAX_FILTERS')
+MAX_CONCURRENT_SAVES = get_app_setting('MEDIA_LIBRARY_MAX_SAVES')
+QUEUE_TIMEOUT = get_app_setting('MEDIA_LIBRARY_QUEUE_TIMEOUT')
+SHARED_LIMITS = get_app_setting('MEDIA_LIBRARY_SHARED_LIMITS')
+
 MEDIA_URL = os.path.join(get_app_setting('SHARED_MEDIA_URL'), 'medialibrary')
@@ -9,7 +9,7 @@ from cilcdjango.core.http import JsonResponse
 from cilcdjango.core.pages import DjangoPage
 from cilcdjango.core.shortcuts import get_object_or_ajax_error
 from cilcdjango.medialibrary.forms import AddMediaForm, MediaLibraryForm, AddMediaGroupForm
-from cilcdjango.medialibrary.models import MediaLibrary, MediaItem
+from cilcdjango.medialibrary.models import MediaLibrary, MediaLibraryGroup, MediaItem, MediaType
 import cilcdjango.medialibrary.settings as _settings
 
 import re
@@ -19,7 +19,7 @@ def _get_library(library_id):
 	"""Return a MediaLibrary instance whose primary key matches `library_id`."""
 	return get_object_or_ajax_error(MediaLibrary, pk=library_id)
 
-@ajax_view
+@ajax_view(cache=_settings.FILTERS_CACHE_TIMEOUT, vary_on=[MediaLibrary, MediaLibraryGroup, MediaItem, MediaType])
 def update_filters(request, library_id=0):
 	"""Return markup to define the media library filters."""
 
@@ -33,12 +33,12 @@ def update_filters(request, library_id=0):
 	})
 
 	return {
-		'markup': {
-			'filters': page.render('media_forms/selection_form_filters.html', to_string=True)
-		}
+		'markup': page.render_fragments({
+			'filters': 'media_forms/selection_form_filters.html'
+		})
 	}
 
-@ajax_view
+@ajax_view(max_concurrent=_settings.MAX_CONCURRENT_FILTERS, queue_timeout=_settings.QUEUE_TIMEOUT, shared_limit=_settings.SHARED_LIMITS)
 def filter_media_library(request, library_id=0):
 	"""
 	Return markup to define the media library selection filters, based upon the
@@ -55,10 +55,10 @@ def filter_media_library(request, library_id=0):
 		})
 
 		return {
-			'markup': {
-				'subtypes': page.render('media_forms/selection_form_filter_subtypes.html', to_string=True),
-				'media':    page.render('media_forms/selection_form_filter_items.html', to_string=True)
-			}
+			'markup': page.render_fragments({
+				'subtypes': 'media_forms/selection_form_filter_subtypes.html',
+				'media':    'media_forms/selection_form_filter_items.html'
+			})
 		}
 	else:
 		raise AjaxError(filter_form.ajax_errors)
@@ -79,9 +79,9 @@ def load_add_media_form(request, library_id=0):
 		'library': library
 	})
 	return {
-		'markup': {
-			'form': page.render('media_forms/add_form.html', to_string=True)
-		}
+		'markup': page.render_fragments({
+			'form': 'media_forms/add_form.html'
+		})
 	}
 
 @ajax_view
@@ -106,13 +106,13 @@ def add_media_group(request, library_id=0):
 	page = DjangoPage(request)
 	page.add_render_args({'media_form': add_form})
 	return {
-		'markup': {
-			'group_selector': page.render('media_forms/add_form_group_selector.html', to_string=True)
-		},
+		'markup': page.render_fragments({
+			'group_selector': 'media_forms/add_form_group_selector.html'
+		}),
 		'message': _("%(group)s added") % {'group': new_group.name}
 	}
 
-@ajax_view
+@ajax_view(max_concurrent=_settings.MAX_CONCURRENT_SAVES, queue_timeout=_settings.QUEUE_TIMEOUT, shared_limit=_settings.SHARED_LIMITS)
 def save_add_media_form(request, library_id=0):
 	"""Add the user-specified medium to the media library."""
 
@@ -132,7 +132,7 @@ def save_add_media_form(request, library_id=0):
 		i_frame=add_form.cleaned_data['is_file']
 	)
 
-@ajax_view
+@ajax_view(cache=_settings.MEDIA_MARKUP_CACHE_TIMEOUT, vary_on=[MediaItem, MediaType])
 def media_markup(request, media_id=0):
 	"""Return the markup needed to render the requested medium."""
 
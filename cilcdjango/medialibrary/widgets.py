@@ -10,13 +10,6 @@ class RichTextEditorWithMediaLibraryWidget(RichTextEditorWidget, SharedMediaMixi
 
 	def __init__(self, library, *args, **kwargs):
 		"""Requires a MediaLibrary instance as its first argument."""
-
-		#  Add in the JavaScript glue code to bridge the library and the editor
-		try:
-			self.SharedMedia.js = self.SharedMedia.js + ('medialibrary/js/editor.js',)
-		except AttributeError:
-			pass
-
 		self._library = library
 		super(RichTextEditorWithMediaLibraryWidget, self).__init__(*args, **kwargs)
 
@@ -36,3 +29,10 @@ class RichTextEditorWithMediaLibraryWidget(RichTextEditorWidget, SharedMediaMixi
 				'library': self._library
 			})
 		)
+
+	class SharedMedia:
+
+		#  Add in the JavaScript glue code to bridge the library and the editor
+		js = RichTextEditorWidget.SharedMedia.js + (
+			'medialibrary/js/editor.js',
+		)